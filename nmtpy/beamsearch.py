@@ -0,0 +1,623 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, Counter
+
+import numpy as np
+
+from .defaults import INT, FLOAT
+
+class BeamHistory(object):
+    """Array-backed bookkeeping for the beam of a single source sentence.
+
+    Every hypothesis expanded at step t is stored in a slot of preallocated
+    (step, beam) arrays along with a backpointer to the slot of its parent
+    at step t-1. Finished hypotheses are only rebuilt by backtracking once
+    the search is over. n_outputs > 1 allows storing several tokens per
+    step (e.g. lemmas and factors)."""
+    def __init__(self, maxlen, beam_size, n_outputs=1, track_alphas=False):
+        self.n_outputs      = n_outputs
+        self.track_alphas   = track_alphas
+
+        self.tokens         = np.zeros((maxlen, beam_size, n_outputs), dtype=INT)
+        self.backptrs       = np.zeros((maxlen, beam_size), dtype=INT)
+        self.scores         = np.zeros((maxlen, beam_size), dtype=FLOAT)
+
+        # Allocated at first step as we don't know the number of annotations
+        self.alphas         = None
+
+        # (step, slot) pairs of finished hypotheses
+        self.finished       = []
+
+        # Best length-normalized score of finished hypotheses
+        self.best_norm      = np.inf
+
+    def add(self, t, tokens, backptrs, scores, alphas=None):
+        """Store the hypotheses expanded at step t into the first slots."""
+        n = len(scores)
+        self.tokens[t, :n]      = np.reshape(tokens, (n, self.n_outputs))
+        self.backptrs[t, :n]    = backptrs
+        self.scores[t, :n]      = scores
+
+        if self.track_alphas:
+            if self.alphas is None:
+                self.alphas = np.zeros(self.scores.shape + (alphas.shape[-1], ), dtype=FLOAT)
+            self.alphas[t, :n] = alphas
+
+    def finish(self, t, slots):
+        """Mark the given slots of step t as finished hypotheses."""
+        self.finished.extend([(t, s) for s in slots])
+        if len(slots) > 0:
+            self.best_norm = min(self.best_norm, self.scores[t, slots].min() / (t + 1))
+
+    def can_stop(self, hyp_scores, maxlen):
+        """Return True if no live hypothesis can beat the best finished one
+        under length normalization. Scores only increase with length which
+        is bounded by maxlen."""
+        return self.best_norm <= hyp_scores.min() / maxlen
+
+    def backtrack(self, t, slot):
+        """Rebuild the tokens and alignments of the hypothesis at (t, slot)."""
+        tokens = np.empty((t + 1, self.n_outputs), dtype=INT)
+        alphas = [None] * (t + 1) if self.track_alphas else None
+
+        for i in range(t, -1, -1):
+            tokens[i] = self.tokens[i, slot]
+            if self.track_alphas:
+                alphas[i] = self.alphas[i, slot]
+            slot = self.backptrs[i, slot]
+
+        return tokens, alphas
+
+    def get_hyps(self):
+        """Return the samples, scores and alignments of finished hypotheses."""
+        samples, scores, alignments = [], [], []
+        for t, slot in self.finished:
+            tokens, alphas = self.backtrack(t, slot)
+            if self.n_outputs == 1:
+                tokens = tokens[:, 0]
+            samples.append(tokens.tolist())
+            scores.append(self.scores[t, slot])
+            alignments.append(alphas)
+
+        if not self.track_alphas:
+            # Don't send back alignments for nothing
+            alignments = None
+
+        return samples, np.array(scores, dtype=FLOAT), alignments
+
+# Beam search arguments enabling pruning and their defaults (disabled)
+PRUNING_ARGS = OrderedDict([
+                ('rel_threshold',   0.),
+                ('abs_threshold',   0.),
+                ('max_cands',       0),
+                ('early_stop',      False),
+                ('maxlen_ratio',    3.),
+                ('adaptive_beam',   0),
+                ('adaptive_mass',   0.9),
+               ])
+
+def get_pruning_args(kwargs):
+    """Return pruning arguments from beam search kwargs with defaults."""
+    return OrderedDict([(k, kwargs.get(k, v)) for k, v in PRUNING_ARGS.items()])
+
+def prune_candidates(costs, parents, stats, rel_threshold=0., abs_threshold=0., max_cands=0, **kwargs):
+    """Return a boolean mask of the selected candidates to keep.
+
+    Candidates are pruned if their probability is lower than rel_threshold
+    times the probability of the best candidate, if their log-probability
+    is lower than the best one by more than abs_threshold or if they exceed
+    max_cands candidates from the same parent hypothesis. Number of pruned
+    candidates are accumulated in stats for each rule."""
+    keep = np.ones(costs.shape, dtype=bool)
+    best = costs.min()
+
+    if rel_threshold > 0:
+        pruned = keep & (costs > best - np.log(rel_threshold))
+        stats['rel_threshold'] += int(pruned.sum())
+        keep &= ~pruned
+
+    if abs_threshold > 0:
+        pruned = keep & (costs > best + abs_threshold)
+        stats['abs_threshold'] += int(pruned.sum())
+        keep &= ~pruned
+
+    if max_cands > 0:
+        n_cands = Counter()
+        for i in np.argsort(costs):
+            if keep[i]:
+                if n_cands[parents[i]] == max_cands:
+                    keep[i] = False
+                    stats['max_cands'] += 1
+                else:
+                    n_cands[parents[i]] += 1
+
+    return keep
+
+def adapt_beam(costs, hyp_scores, stats, n_models=1, adaptive_beam=0, adaptive_mass=0.9, **kwargs):
+    """Return a boolean mask of the best candidates whose probability mass
+    reaches adaptive_mass, keeping at least adaptive_beam of them.
+
+    The mass is relative to the total probability of the parent hypotheses
+    which is also the total probability of all their expansions. Costs of
+    ensembles are sums of log-probs and are scaled by n_models, i.e. the
+    geometric mean of the models' probabilities is used. Number of dropped
+    candidates are accumulated in stats."""
+    keep = np.ones(costs.shape, dtype=bool)
+    if adaptive_beam == 0:
+        return keep
+
+    # Shift by the best parent for numerical stability
+    shift = hyp_scores.min()
+    probs = np.exp(-(costs - shift) / n_models) / np.exp(-(hyp_scores - shift) / n_models).sum()
+
+    order = np.argsort(costs)
+    width = max(adaptive_beam, np.searchsorted(np.cumsum(probs[order]), adaptive_mass) + 1)
+    keep[order[width:]] = False
+    stats['adaptive_beam'] += int((~keep).sum())
+    return keep
+
+def top_factored_candidates(hyp_scores, log_p_lem, log_p_fact, k):
+    """Return the parents, lemmas, factors and costs of the k best
+    (hypothesis, lemma, factor) expansions.
+
+    The cost of an expansion is the sum of the lemma and factor
+    log-probabilities. Only the k best lemmas and factors of each
+    hypothesis can be part of the k best expansions so the search is
+    restricted to these."""
+    n_hyps = hyp_scores.size
+    k_lem = min(k, log_p_lem.shape[1])
+    k_fact = min(k, log_p_fact.shape[1])
+
+    # n_hyps x k_lem and n_hyps x k_fact best candidates of each hypothesis
+    rows = np.arange(n_hyps)[:, None]
+    lems = (-log_p_lem).argpartition(k_lem - 1, axis=1)[:, :k_lem]
+    facts = (-log_p_fact).argpartition(k_fact - 1, axis=1)[:, :k_fact]
+    costs_lem = hyp_scores[:, None] - log_p_lem[rows, lems]
+    costs_fact = -log_p_fact[rows, facts]
+
+    # n_hyps x k_lem x k_fact combinations
+    costs = (costs_lem[:, :, None] + costs_fact[:, None, :]).ravel()
+    k = min(k, costs.size)
+    ranks = costs.argpartition(k - 1)[:k]
+    parents, lem_ranks, fact_ranks = np.unravel_index(ranks, (n_hyps, k_lem, k_fact))
+
+    return parents, lems[parents, lem_ranks], facts[parents, fact_ranks], costs[ranks]
+
+def beam_search(inputs, f_inits, f_nexts, beam_size=12, maxlen=50, suppress_unks=False, **kwargs):
+    """Beam search over a single source sentence.
+
+    f_inits and f_nexts are the samplers of the ensemble members, Theano
+    functions or any callables following the same convention (see
+    nmtpy.npmodel). A fused sampler computing a whole ensemble gives its
+    number of members as n_models. Returns the samples, their scores and
+    alignments."""
+    # Number of models
+    n_models        = len(f_inits)
+    # Number of ensemble members, more than the models if they are fused
+    n_members       = kwargs.get('n_models', n_models)
+
+    # Ensembling-aware lists
+    next_states     = [None] * n_models
+    text_ctxs       = [None] * n_models
+    aux_ctxs        = [[]] * n_models
+    tiled_ctxs      = [None] * n_models
+    next_log_ps     = [None] * n_models
+    alphas          = [None] * n_models
+
+    for i, f_init in enumerate(f_inits):
+        # Get next_state and initial contexts and save them
+        # text_ctx: the set of textual annotations
+        # aux_ctx: the set of auxiliary (ex: image) annotations and
+        #          precomputed projections, given as-is to f_next
+        result = list(f_init(*inputs))
+        next_states[i], text_ctxs[i], aux_ctxs[i] = result[0], result[1], result[2:]
+        tiled_ctxs[i] = text_ctxs[i]
+
+    # Beginning-of-sentence indicator is -1 unless we continue
+    # a given target prefix (see nmtpy.interactive)
+    next_w = kwargs.get('init_word', -1) * np.ones((1,), dtype=INT)
+
+    # Pruning options and counters of pruned hypotheses for each rule
+    pruning = get_pruning_args(kwargs)
+    stats = kwargs.get('stats', None)
+    if stats is None:
+        stats = Counter()
+
+    # maxlen or maxlen_ratio (default: 3) times source length
+    # NOTE: This will break if [0] is not the src sentence.
+    src_len = inputs[0].shape[0]
+    default_maxlen = min(maxlen, src_len * 3)
+    maxlen = min(maxlen, int(np.ceil(src_len * pruning['maxlen_ratio'])))
+
+    # Words, backpointers, scores (and alignments) of expanded hypotheses
+    # NOTE: f_next's from lean samplers do not return alphas at all.
+    track_alphas = kwargs.get('get_att_alphas', False)
+    beam = BeamHistory(maxlen, beam_size, track_alphas=track_alphas)
+
+    # Shortlisted target vocabulary given to f_next (see nmtpy.shortlist)
+    vocab = kwargs.get('vocab', None)
+    shortlist = [] if vocab is None else [vocab]
+
+    # Initially we have one empty hypothesis with a score of 0
+    hyp_scores  = np.zeros(1, dtype=FLOAT)
+
+    # History slots of the live hypotheses at the previous step
+    live_slots  = np.zeros(1, dtype=INT)
+    live_beam   = 1
+
+    for t in range(maxlen):
+        # Get next states
+        # In the first iteration, we provide -1 and obtain the log_p's for the
+        # first word. In the following iterations tiled_ctx becomes a batch
+        # of duplicated left hypotheses. tiled_ctx is always the same except
+        # the size of the 2nd dimension as the context vectors of the source
+        # sequence is always the same regardless of the decoding process.
+        # next_state's shape is (live_beam, rnn_dim)
+
+        # We do this for each model
+        for m, f_next in enumerate(f_nexts):
+            result = f_next(*([next_w, next_states[m], tiled_ctxs[m]] + aux_ctxs[m] + shortlist))
+            next_log_ps[m], next_states[m] = result[:2]
+            if track_alphas:
+                alphas[m] = result[2]
+
+            if suppress_unks:
+                next_log_ps[m][:, 1] = -np.inf
+
+        # Number of hypotheses expanded at this step
+        stats['beam_width'] += live_beam
+        stats['steps'] += 1
+
+        # Compute sum of log_p's for the current hypotheses
+        cand_scores = hyp_scores[:, None] - sum(next_log_ps)
+
+        # Flatten by modifying .shape (faster)
+        cand_scores.shape = cand_scores.size
+
+        # Take the best hypotheses to fill the beam
+        # argpartition makes a partial sort which is faster than argsort
+        # (Idea taken from https://github.com/rsennrich/nematus)
+        n_open = beam_size - len(beam.finished)
+        ranks_flat = cand_scores.argpartition(n_open-1)[:n_open]
+
+        # Get the costs
+        costs = cand_scores[ranks_flat]
+
+        # Prune unpromising candidates and narrow down confident steps if requested
+        n_words = next_log_ps[0].shape[1]
+        keep = prune_candidates(costs, ranks_flat // n_words, stats, **pruning)
+        keep &= adapt_beam(costs, hyp_scores, stats, n_members, **pruning)
+        ranks_flat, costs = ranks_flat[keep], costs[keep]
+
+        # Find out to which initial hypothesis idx this was belonging
+        # Find out the idx of the appended word
+        trans_idxs  = ranks_flat // n_words
+        word_idxs   = ranks_flat % n_words
+
+        if vocab is not None:
+            # Map shortlist positions back to target vocabulary idxs
+            word_idxs = vocab[word_idxs]
+
+        # Store new hypotheses along with pointers to their parents' slots
+        # Mean alphas for the mean model (n_models > 1)
+        beam.add(t, word_idxs, live_slots[trans_idxs], costs,
+                 (sum(alphas) / n_models)[trans_idxs] if track_alphas else None)
+
+        # <eos> found, separate out finished hypotheses
+        is_eos = word_idxs == 0
+        beam.finish(t, np.nonzero(is_eos)[0])
+
+        live_slots  = np.nonzero(~is_eos)[0]
+        live_beam   = live_slots.size
+
+        if live_beam > 0 and pruning['early_stop'] and beam.can_stop(costs[live_slots], maxlen):
+            # None of the live hypotheses can beat the best finished one
+            stats['early_stop'] += live_beam
+            live_slots  = live_slots[:0]
+            live_beam   = 0
+
+        if live_beam == 0:
+            break
+
+        # Scores, last words and decoder states of the live hypotheses
+        hyp_scores  = costs[live_slots]
+        next_w      = word_idxs[live_slots]
+        trans_idxs  = trans_idxs[live_slots]
+        next_states = [st[trans_idxs] for st in next_states]
+        tiled_ctxs  = [np.tile(ctx, [live_beam, 1]) for ctx in text_ctxs]
+
+    if live_beam > 0 and maxlen < default_maxlen:
+        # Hypotheses cut by a smaller maxlen_ratio
+        stats['maxlen_ratio'] += live_beam
+
+    # dump every remaining hypotheses
+    beam.finish(t, live_slots)
+
+    return beam.get_hyps()
+
+def batch_beam_search(inputs, f_inits, f_nexts, beam_size=12, maxlen=50, suppress_unks=False, **kwargs):
+    """Beam search over a padded minibatch of source sentences.
+
+    f_init/f_next should come from build_sampler(batched=True): every
+    f_init output after the initial state (contexts, source mask) has
+    its samples on the 2nd axis and is given back to f_next indexed by
+    the source sentence of each live hypothesis. The live hypotheses of
+    all sentences are stacked into a single f_next call per model while
+    each sentence keeps its own beam. Returns a list of
+    (samples, scores, alignments) tuples, one per source sentence. As
+    in beam_search, n_models gives the members of a fused sampler."""
+    # Number of models
+    n_models        = len(f_inits)
+    # Number of ensemble members, more than the models if they are fused
+    n_members       = kwargs.get('n_models', n_models)
+
+    # Ensembling-aware lists
+    next_states     = [None] * n_models
+    ctxs            = [None] * n_models
+    next_log_ps     = [None] * n_models
+    alphas          = [None] * n_models
+
+    for i, f_init in enumerate(f_inits):
+        result = list(f_init(*inputs))
+        next_states[i], ctxs[i] = result[0], result[1:]
+
+    # Source lengths including <eos>
+    # NOTE: This will break if [1] is not the source mask.
+    src_lens        = inputs[1].sum(0).astype(INT)
+    n_sents         = src_lens.size
+
+    # Pruning options and counters of pruned hypotheses for each sentence
+    pruning         = get_pruning_args(kwargs)
+    stats           = kwargs.get('stats', None)
+    if stats is None:
+        stats = [Counter() for _ in range(n_sents)]
+
+    # maxlen or maxlen_ratio (default: 3) times source length
+    default_maxlens = np.minimum(maxlen, src_lens * 3)
+    maxlens         = np.minimum(maxlen, np.ceil(src_lens * pruning['maxlen_ratio'])).astype(INT)
+
+    # Separate history for each sentence
+    # NOTE: f_next's from lean samplers do not return alphas at all.
+    track_alphas    = kwargs.get('get_att_alphas', False)
+    beams           = [BeamHistory(maxlens[s], beam_size, track_alphas=track_alphas) for s in range(n_sents)]
+
+    # Shortlisted target vocabulary of the whole minibatch
+    vocab           = kwargs.get('vocab', None)
+    shortlist       = [] if vocab is None else [vocab]
+
+    # Initially each sentence has one empty hypothesis with a score of 0
+    hyp_scores      = [np.zeros(1, dtype=FLOAT) for _ in range(n_sents)]
+
+    # History slots of the live hypotheses at the previous step
+    live_slots      = [np.zeros(1, dtype=INT) for _ in range(n_sents)]
+
+    # Source sentence of each row given to f_next
+    hyp_sents       = np.arange(n_sents)
+
+    # Beginning-of-sentence indicator is -1
+    next_w          = -1 * np.ones((n_sents,), dtype=INT)
+    tiled_ctxs      = ctxs
+
+    for t in range(maxlens.max()):
+        # Number of hypotheses expanded at this step
+        for s in range(n_sents):
+            if live_slots[s].size > 0:
+                stats[s]['beam_width'] += live_slots[s].size
+                stats[s]['steps'] += 1
+
+        # Get next states for the stacked hypotheses of all sentences
+        for m, f_next in enumerate(f_nexts):
+            result = f_next(*([next_w, next_states[m]] + tiled_ctxs[m] + shortlist))
+            next_log_ps[m], next_states[m] = result[:2]
+            if track_alphas:
+                alphas[m] = result[2]
+
+            if suppress_unks:
+                next_log_ps[m][:, 1] = -np.inf
+
+        # Sum of log_p's and mean alphas for the mean model (n_models > 1)
+        sum_log_ps  = sum(next_log_ps)
+        mean_alphas = sum(alphas) / n_models if track_alphas else None
+        n_words     = sum_log_ps.shape[1]
+
+        # Rows and last words of the surviving hypotheses
+        new_rows    = []
+        new_words   = []
+
+        # Offset of the current sentence's rows
+        offset      = 0
+
+        for s in range(n_sents):
+            n_hyps = live_slots[s].size
+            if n_hyps == 0:
+                # This sentence is already finished
+                continue
+
+            # Compute sum of log_p's for the current hypotheses
+            cand_scores = hyp_scores[s][:, None] - sum_log_ps[offset:offset + n_hyps]
+            cand_scores.shape = cand_scores.size
+
+            # Take the best hypotheses to fill the beam of this sentence
+            n_open      = beam_size - len(beams[s].finished)
+            ranks_flat  = cand_scores.argpartition(n_open-1)[:n_open]
+            costs       = cand_scores[ranks_flat]
+
+            # Prune unpromising candidates and narrow down confident steps if requested
+            keep        = prune_candidates(costs, ranks_flat // n_words, stats[s], **pruning)
+            keep       &= adapt_beam(costs, hyp_scores[s], stats[s], n_members, **pruning)
+            ranks_flat  = ranks_flat[keep]
+            costs       = costs[keep]
+
+            rows        = offset + ranks_flat // n_words
+            word_idxs   = ranks_flat % n_words
+
+            if vocab is not None:
+                # Map shortlist positions back to target vocabulary idxs
+                word_idxs = vocab[word_idxs]
+
+            # Drop the attention over padded source positions
+            beams[s].add(t, word_idxs, live_slots[s][rows - offset], costs,
+                         mean_alphas[rows, :src_lens[s]] if track_alphas else None)
+
+            is_eos = word_idxs == 0
+            if t + 1 == maxlens[s]:
+                if maxlens[s] < default_maxlens[s]:
+                    # Hypotheses cut by a smaller maxlen_ratio
+                    stats[s]['maxlen_ratio'] += int((~is_eos).sum())
+                # Reached maxlen for this sentence, every hypothesis will be dumped
+                is_eos[:] = True
+
+            # <eos> found, separate out finished hypotheses
+            beams[s].finish(t, np.nonzero(is_eos)[0])
+
+            live_slots[s]   = np.nonzero(~is_eos)[0]
+
+            if live_slots[s].size > 0 and pruning['early_stop'] and \
+                    beams[s].can_stop(costs[live_slots[s]], maxlens[s]):
+                # None of the live hypotheses can beat the best finished one
+                stats[s]['early_stop'] += live_slots[s].size
+                live_slots[s]   = live_slots[s][:0]
+            hyp_scores[s]   = costs[live_slots[s]]
+
+            new_rows.append(rows[live_slots[s]])
+            new_words.append(word_idxs[live_slots[s]])
+
+            offset += n_hyps
+
+        new_rows = np.concatenate(new_rows)
+        if new_rows.size == 0:
+            break
+
+        # Gather the last words and states of the live hypotheses at once
+        next_w      = np.concatenate(new_words)
+        next_states = [st[new_rows] for st in next_states]
+
+        # Gather the contexts of the live hypotheses only if the layout changed
+        new_sents   = np.repeat(np.arange(n_sents), [ls.size for ls in live_slots])
+        if not np.array_equal(new_sents, hyp_sents):
+            hyp_sents   = new_sents
+            tiled_ctxs  = [[c[:, hyp_sents] for c in ctx] for ctx in ctxs]
+
+    return [beam.get_hyps() for beam in beams]
+
+def speculative_search(inputs, f_inits, f_verifies, f_draft_init, f_draft_next,
+                       beam_size=1, maxlen=50, suppress_unks=False, draft_len=4, **kwargs):
+    """Beam search over a single source sentence with a draft model.
+
+    At each round, the draft model (f_draft_init/f_draft_next, a sampler
+    from build_sampler()) greedily proposes draft_len words after every
+    live hypothesis. The models (f_inits/f_verifies from build_sampler()
+    and build_verifier()) score all these words in a single teacher-forced
+    pass. Beam search then proceeds with these log-probabilities as long
+    as the hypotheses follow the drafts of their round's parents, which is
+    up to the first disagreement when beam_size is 1. The result is the
+    same as beam_search() without pruning. Numbers of drafted and accepted
+    words, verification passes and decoding steps are counted in stats."""
+    # Number of models
+    n_models        = len(f_inits)
+
+    states          = [None] * n_models
+    text_ctxs       = [None] * n_models
+    aux_ctxs        = [[]] * n_models
+
+    for i, f_init in enumerate(f_inits):
+        result = list(f_init(*inputs))
+        states[i], text_ctxs[i], aux_ctxs[i] = result[0], result[1], result[2:]
+
+    result = list(f_draft_init(*inputs))
+    draft_state, draft_ctx, draft_aux = result[0], result[1], result[2:]
+
+    stats = kwargs.get('stats', None)
+    if stats is None:
+        stats = Counter()
+
+    # maxlen_ratio (default: 3) times source length
+    src_len = inputs[0].shape[0]
+    maxlen = min(maxlen, int(np.ceil(src_len * kwargs.get('maxlen_ratio', 3.))))
+
+    beam = BeamHistory(maxlen, beam_size)
+
+    # Live hypotheses: scores, history slots, last words and the
+    # states of the models and of the draft model before the last words
+    hyp_scores  = np.zeros(1, dtype=FLOAT)
+    live_slots  = np.zeros(1, dtype=INT)
+    last_w      = -1 * np.ones((1,), dtype=INT)
+
+    t = 0
+    while t < maxlen:
+        n_hyps  = hyp_scores.size
+        n_draft = min(draft_len, maxlen - t - 1)
+
+        # ys[0] are the last words and ys[j] the j'th drafted words,
+        # draft_states[j] is the state of the draft model after ys[j]
+        ys = np.empty((n_draft + 1, n_hyps), dtype=INT)
+        ys[0] = last_w
+        draft_states = []
+        tiled_ctx = np.tile(draft_ctx, [n_hyps, 1])
+        for j in range(n_draft + 1):
+            result = f_draft_next(*([ys[j], draft_state, tiled_ctx] + draft_aux))
+            draft_state = result[1]
+            draft_states.append(draft_state)
+            if j < n_draft:
+                log_p = result[0]
+                if suppress_unks:
+                    log_p[:, 1] = -np.inf
+                ys[j + 1] = log_p.argmax(1)
+
+        # Log-probabilities and states after each of ys for every model
+        log_ps, verified_states = 0., []
+        for m, f_verify in enumerate(f_verifies):
+            log_p, st = f_verify(*([ys, states[m], np.tile(text_ctxs[m], [n_hyps, 1])] + aux_ctxs[m]))[:2]
+            if suppress_unks:
+                log_p[:, :, 1] = -np.inf
+            log_ps = log_ps + log_p
+            verified_states.append(st)
+
+        stats['verify_calls'] += 1
+        stats['drafted'] += n_draft * n_hyps
+
+        # Beam search steps along the drafts, j being the step in this round
+        roots = np.arange(n_hyps)
+        for j in range(n_draft + 1):
+            stats['decode_steps'] += 1
+
+            cand_scores = hyp_scores[:, None] - log_ps[j, roots]
+            n_words = cand_scores.shape[1]
+            cand_scores.shape = cand_scores.size
+
+            n_open = beam_size - len(beam.finished)
+            ranks_flat = cand_scores.argpartition(n_open-1)[:n_open]
+            costs = cand_scores[ranks_flat]
+            trans_idxs  = ranks_flat // n_words
+            word_idxs   = ranks_flat % n_words
+
+            beam.add(t, word_idxs, live_slots[trans_idxs], costs)
+
+            is_eos = word_idxs == 0
+            beam.finish(t, np.nonzero(is_eos)[0])
+            t += 1
+
+            live_slots  = np.nonzero(~is_eos)[0]
+            if live_slots.size == 0 or t == maxlen:
+                break
+
+            hyp_scores  = costs[live_slots]
+            parents     = roots[trans_idxs[live_slots]]
+            last_w      = word_idxs[live_slots]
+
+            # Continue while all the hypotheses follow the drafts
+            follows = (ys[j + 1, parents] == last_w) if j < n_draft else np.zeros(parents.shape, dtype=bool)
+            stats['accepted'] += int(follows.sum())
+            if not follows.all():
+                # Next round starts from the states before the last words
+                states = [st[j, parents] for st in verified_states]
+                draft_state = draft_states[j][parents]
+                break
+            roots = parents
+
+        if live_slots.size == 0:
+            break
+
+    # dump every remaining hypotheses
+    beam.finish(t - 1, live_slots)
+
+    return beam.get_hyps()
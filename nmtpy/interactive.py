@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import inspect
+from bisect import bisect_left
+
+import numpy as np
+
+from .defaults import INT, FLOAT
+from .nmtutils import sent_to_idx, idx_to_sent
+from .iterators.iterator import Iterator
+
+class PrefixCompleter(object):
+    """Complete the target prefixes typed in a post-editing interface.
+
+    For each open session the f_init outputs of the source sentence are
+    kept along with the decoder states after each confirmed prefix word,
+    i.e. the complete words typed so far. When the prefix changes, only
+    its new words are fed to f_next (states are rolled back if words were
+    deleted) and a beam search of at most max_suffix steps completes it.
+    The cost of a keystroke thus depends on the suffix length and not on
+    the sentence length. A partially typed last word restricts the first
+    word of the completion to the vocabulary words starting with it.
+
+    models should share their vocabularies and provide the beam_search()
+    of nmtpy.models.attention, which is used for ensembling as well."""
+    def __init__(self, models, beam_size=5, max_suffix=20, suppress_unks=True):
+        self.models         = models
+        self.model          = models[0]
+        self.beam_size      = beam_size
+        self.max_suffix     = max_suffix
+        self.suppress_unks  = suppress_unks
+
+        for model in self.models:
+            if 'get_att_alphas' in inspect.getargspec(model.build_sampler).args:
+                model.build_sampler(get_att_alphas=False)
+            else:
+                model.build_sampler()
+
+        self.f_inits        = [m.f_init for m in self.models]
+        self.f_nexts        = [m.f_next for m in self.models]
+
+        # Sorted target vocabulary for the lookup of partial words
+        words = [(w, i) for i, w in self.model.trg_idict.items() if 1 < i < self.model.n_words_trg]
+        words.sort()
+        self.vocab_words    = [w for w, _ in words]
+        self.vocab_idxs     = np.array([i for _, i in words], dtype=INT)
+
+        # Active sessions
+        self.sessions       = {}
+
+    def open(self, session_id, src):
+        """Encode the source sentence of a new session."""
+        seq = sent_to_idx(self.model.src_dict, src.split(), self.model.n_words_src)
+        x, _ = Iterator.mask_data([seq])
+
+        init_states, ctxs = [], []
+        for f_init in self.f_inits:
+            result = list(f_init(x))
+            init_states.append(result[0])
+            ctxs.append(result[1:])
+
+        # states[k] are the decoder states of each model after the
+        # first k prefix words and costs[k] is the cost of these words.
+        self.sessions[session_id] = {'x': x, 'ctxs': ctxs, 'words': [],
+                                     'states': [init_states], 'costs': [0.]}
+
+    def close(self, session_id):
+        """Forget the cached states of a session."""
+        del self.sessions[session_id]
+
+    def lookup(self, partial):
+        """Return the idxs of the target words starting with partial."""
+        start = bisect_left(self.vocab_words, partial)
+        end = bisect_left(self.vocab_words, partial + '\U0010ffff', start)
+        return self.vocab_idxs[start:end]
+
+    def advance(self, session, words):
+        """Bring the cached states of a session to the prefix words."""
+        # Keep the longest common prefix
+        n = 0
+        while n < min(len(words), len(session['words'])) and words[n] == session['words'][n]:
+            n += 1
+        del session['words'][n:]
+        del session['states'][n + 1:]
+        del session['costs'][n + 1:]
+
+        # Feed the new words, -1 being the beginning-of-sentence indicator
+        for w in words[n:]:
+            prev_w = np.array([session['words'][-1] if session['words'] else -1], dtype=INT)
+            log_p, states = 0., []
+            for f_next, state, ctxs in zip(self.f_nexts, session['states'][-1], session['ctxs']):
+                result = f_next(*([prev_w, state] + ctxs))
+                log_p += result[0][0, w]
+                states.append(result[1])
+
+            session['words'].append(w)
+            session['states'].append(states)
+            session['costs'].append(session['costs'][-1] - log_p)
+
+    def restrict_first_word(self, f_next, idxs):
+        """Return an f_next whose first call only allows the words in idxs."""
+        mask = np.full((self.model.n_words_trg, ), -np.inf, dtype=FLOAT)
+        mask[idxs] = 0.
+        first = True
+
+        def f_next_restricted(*args):
+            nonlocal first
+            result = list(f_next(*args))
+            if first:
+                result[0] = result[0] + mask
+                first = False
+            return result
+        return f_next_restricted
+
+    def complete(self, session_id, prefix):
+        """Return the best completion of a typed target prefix.
+
+        The completion starts with the rest of the last word if the
+        prefix does not end with a space."""
+        session = self.sessions[session_id]
+
+        tokens = prefix.split()
+        partial, idxs = None, None
+        if tokens and not prefix[-1].isspace():
+            partial = tokens[-1]
+            idxs = self.lookup(partial)
+            if idxs.size > 0:
+                tokens = tokens[:-1]
+            else:
+                # Out of vocabulary, consider it as a complete word
+                partial, idxs = None, None
+
+        words = sent_to_idx(self.model.trg_dict, tokens, self.model.n_words_trg)
+        self.advance(session, words)
+
+        # Continue from the states after the prefix
+        states = session['states'][-1]
+        f_inits = [lambda *args, st=st, ctxs=ctxs: [st] + ctxs for st, ctxs in zip(states, session['ctxs'])]
+        f_nexts = self.f_nexts
+        if idxs is not None:
+            f_nexts = [self.restrict_first_word(f, idxs) for f in f_nexts]
+
+        hyps, scores, _ = self.model.beam_search([session['x']], f_inits, f_nexts,
+                                                 beam_size=self.beam_size, maxlen=self.max_suffix,
+                                                 suppress_unks=self.suppress_unks,
+                                                 init_word=words[-1] if words else -1)
+
+        # Pick the best hypothesis normalized by the full sentence length
+        lengths = np.array([len(words) + len(h) for h in hyps])
+        best = np.argmin((np.array(scores) + session['costs'][-1]) / lengths)
+        completion = idx_to_sent(self.model.trg_idict, hyps[best])
+        if partial is not None:
+            # Only the missing characters of the last word
+            completion = completion[len(partial):]
+        return completion
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 
+from collections import OrderedDict
+
 from ..sysutils   import fopen
 from .iterator    import Iterator
 from .homogeneous import HomogeneousData
@@ -103,3 +105,13 @@ class BiTextIterator(Iterator):
         src, src_mask = Iterator.mask_data([self._seqs[i][0] for i in idxs])
         trg, trg_mask = Iterator.mask_data([self._seqs[i][1] for i in idxs])
         return (src, src_mask, trg, trg_mask)
+
+    def get_sorted_batches(self):
+        """Yields (sample idxs, minibatch) pairs with samples sorted by
+        target and source lengths to minimize padding."""
+        idxs = sorted(range(self.n_samples),
+                      key=lambda i: (len(self._seqs[i][1]), len(self._seqs[i][0])))
+        for i in range(0, self.n_samples, self.batch_size):
+            batch_idxs = idxs[i:i + self.batch_size]
+            data = self.mask_seqs(batch_idxs)
+            yield batch_idxs, OrderedDict([(k, data[j]) for j, k in enumerate(self._keys)])
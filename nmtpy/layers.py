@@ -4,7 +4,7 @@ import numpy as np
 import theano
 from theano import tensor
 
-from .nmtutils import norm_weight, ortho_weight, pp
+from .nmtutils import norm_weight, ortho_weight, pp, SVD_A, SVD_B
 from .defaults import FLOAT
 
 # Shorthands for activations
@@ -21,6 +21,32 @@ def tensor_slice(_x, n, dim):
         return _x[:, n*dim:(n+1)*dim]
     return _x[n*dim:(n+1)*dim]
 
+#######################################################
+# Weights which may be factorized into a low-rank pair
+# (name_svdA, name_svdB) by nmt-compress
+#######################################################
+def weight_dot(tparams, x, name, cols=None):
+    """Return dot(x, W) (only for the columns cols of W if given)."""
+    if name + SVD_A in tparams:
+        B = tparams[name + SVD_B]
+        return tensor.dot(tensor.dot(x, tparams[name + SVD_A]), B if cols is None else B[:, cols])
+    W = tparams[name]
+    return tensor.dot(x, W if cols is None else W[:, cols])
+
+def weight_dot_t(tparams, x, name, rows=None):
+    """Return dot(x, W.T) (only for the rows of W if given)."""
+    if name + SVD_A in tparams:
+        A = tparams[name + SVD_A]
+        return tensor.dot(tensor.dot(x, tparams[name + SVD_B].T), (A if rows is None else A[rows]).T)
+    W = tparams[name]
+    return tensor.dot(x, (W if rows is None else W[rows]).T)
+
+def weight_rows(tparams, name, idxs):
+    """Return the rows idxs of W, e.g. embeddings."""
+    if name + SVD_A in tparams:
+        return tensor.dot(tparams[name + SVD_A][idxs], tparams[name + SVD_B])
+    return tparams[name][idxs]
+
 ###############################################
 # Returns the initializer and the layer itself
 ###############################################
@@ -170,7 +196,7 @@ def param_init_fflayer(params, nin, nout, scale=0.01, ortho=True, prefix='ff'):
 
 def fflayer(tparams, state_below, prefix='ff', activ='tanh'):
     return eval(activ) (
-        tensor.dot(state_below, tparams[pp(prefix, 'W')]) +
+        weight_dot(tparams, state_below, pp(prefix, 'W')) +
         tparams[pp(prefix, 'b')]
         )
 
@@ -295,7 +321,8 @@ def param_init_gru_cond(params, nin, dim, dimctx, scale=0.01, prefix='gru_cond',
     return params
 
 def gru_cond_layer(tparams, state_below, context, prefix='gru_cond',
-                   mask=None, one_step=False, init_state=None, context_mask=None, layernorm=False):
+                   mask=None, one_step=False, init_state=None, context_mask=None, layernorm=False,
+                   pctx=None, state_below_=None, state_belowx=None):
     if one_step:
         assert init_state, 'previous state must be provided'
 
@@ -325,15 +352,22 @@ def gru_cond_layer(tparams, state_below, context, prefix='gru_cond',
 
     # These two dot products are same with gru_layer, refer to the equations.
     # [W_r * X + b_r, W_z * X + b_z]
-    state_below_ = tensor.dot(state_below, tparams[pp(prefix, 'W')]) + tparams[pp(prefix, 'b')]
+    # Samplers may give them gathered from precomputed lookup tables
+    if state_below_ is None:
+        state_below_ = tensor.dot(state_below, tparams[pp(prefix, 'W')]) + tparams[pp(prefix, 'b')]
 
     # input to compute the hidden state proposal
     # This is the [W*x]_j in the eq. 8 of the paper
-    state_belowx = tensor.dot(state_below, tparams[pp(prefix, 'Wx')]) + tparams[pp(prefix, 'bx')]
+    if state_belowx is None:
+        state_belowx = tensor.dot(state_below, tparams[pp(prefix, 'Wx')]) + tparams[pp(prefix, 'bx')]
 
     # Wc_att: dimctx -> dimctx
     # Linearly transform the context to another space with same dimensionality
-    pctx_ = tensor.dot(context, tparams[pp(prefix, 'Wc_att')]) + tparams[pp(prefix, 'b_att')]
+    # This does not depend on the decoder, samplers precompute it once
+    if pctx is None:
+        pctx_ = tensor.dot(context, tparams[pp(prefix, 'Wc_att')]) + tparams[pp(prefix, 'b_att')]
+    else:
+        pctx_ = pctx
 
     # Prepare for step()
     seqs = [mask, state_below_, state_belowx]
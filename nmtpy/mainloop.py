@@ -32,6 +32,7 @@ class MainLoop(object):
         self.valid_start    = train_args.valid_start
         self.beam_size      = train_args.valid_beam
         self.njobs          = train_args.valid_njobs
+        self.valid_numpy    = train_args.valid_numpy
         self.f_valid        = train_args.valid_freq
         self.valid_save_hyp = train_args.valid_save_hyp  #save validations outputs
         self.f_sample       = train_args.sample_freq
@@ -205,7 +206,8 @@ class MainLoop(object):
                                                                 metric=self.valid_metric,
                                                                 mode='beamsearch',
                                                                 valid_mode=self.valid_mode,
-                                                                f_valid_out=f_valid_out)
+                                                                f_valid_out=f_valid_out,
+                                                                numpy=self.valid_numpy)
 
                 self._print("Validation %2d - %s" % (self.vctr, metric_str))
 
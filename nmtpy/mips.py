@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .defaults import FLOAT
+
+class ClusteredSoftmax(object):
+    """Approximate output layer over k-means clusters of output embeddings.
+
+    The columns of the output weight matrix are clustered once. At each
+    decoding step the cluster centroids are scored first and the exact
+    logits are only computed for the words of the n_best clusters of each
+    hypothesis. The softmax normalizer of the remaining words is estimated
+    from the centroid score and the size of their clusters. <eos> and <unk>
+    are always scored exactly."""
+    def __init__(self, W, b, n_clusters=256, n_best=16, n_iters=10, seed=1234):
+        # W: dim x n_words, b: n_words
+        self.W          = W
+        self.b          = b
+        self.n_words    = W.shape[1]
+        # Can not have more clusters than words to seed them with
+        n_clusters      = min(n_clusters, self.n_words)
+        self.n_best     = min(n_best, n_clusters)
+
+        # Cluster the output embeddings (n_words x dim) with k-means
+        emb             = W.T
+        rng             = np.random.RandomState(seed)
+        centroids       = emb[rng.choice(self.n_words, n_clusters, replace=False)]
+        for i in range(n_iters):
+            # argmin of ||e - c||^2 = argmax of e.c - ||c||^2 / 2
+            assign = (emb.dot(centroids.T) - 0.5 * (centroids ** 2).sum(1)).argmax(1)
+            for c in range(n_clusters):
+                members = emb[assign == c]
+                # Keep the previous centroid if the cluster is empty
+                if len(members) > 0:
+                    centroids[c] = members.mean(0)
+
+        self.centroids  = centroids.astype(FLOAT)
+        self.members    = [np.nonzero(assign == c)[0] for c in range(n_clusters)]
+        self.sizes      = np.array([m.size for m in self.members], dtype=FLOAT)
+        self.biases     = np.array([b[m].mean() if m.size > 0 else 0. for m in self.members], dtype=FLOAT)
+
+    def __call__(self, h):
+        """Return approximate log-probs for the readout h (n_hyps x dim).
+
+        Words out of the selected clusters get -inf."""
+        # n_hyps x n_clusters
+        cscores = h.dot(self.centroids.T) + self.biases
+
+        # Union of the best clusters of each hypothesis
+        best    = np.argpartition(-cscores, self.n_best - 1, axis=1)[:, :self.n_best]
+        chosen  = np.zeros(len(self.members), dtype=bool)
+        chosen[best.ravel()] = True
+
+        words   = np.union1d([0, 1], np.concatenate([self.members[c] for c in np.nonzero(chosen)[0]]))
+        logits  = h.dot(self.W[:, words]) + self.b[words]
+
+        # log-sum-exp of exact logits and estimated masses of the other clusters
+        others  = ~chosen & (self.sizes > 0)
+        rest    = cscores[:, others] + np.log(self.sizes[others])
+        maxes   = np.maximum(logits.max(1), rest.max(1) if rest.size > 0 else -np.inf)
+        norm    = np.exp(logits - maxes[:, None]).sum(1) + np.exp(rest - maxes[:, None]).sum(1)
+        log_z   = maxes + np.log(norm)
+
+        log_probs = np.full((h.shape[0], self.n_words), -np.inf, dtype=FLOAT)
+        log_probs[:, words] = logits - log_z[:, None]
+        return log_probs
+
+    def wrap(self, f_next):
+        """Return an f_next whose first output (the readout) goes through
+        the approximate output layer."""
+        def f_next_approx(*args):
+            result = list(f_next(*args))
+            result[0] = self(result[0])
+            return result
+        return f_next_approx
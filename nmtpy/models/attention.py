@@ -8,9 +8,11 @@ import theano
 import theano.tensor as tensor
 
 # Ours
-from ..layers import dropout, tanh, get_new_layer
+from ..layers import dropout, tanh, get_new_layer, weight_dot, weight_dot_t, weight_rows
 from ..defaults import INT, FLOAT
-from ..nmtutils import norm_weight, invert_dictionary, load_dictionary
+from ..beamsearch import beam_search, batch_beam_search, speculative_search
+from ..mips import ClusteredSoftmax
+from ..nmtutils import norm_weight, invert_dictionary, load_dictionary, factorize_params, get_weight
 from ..iterators.text import TextIterator
 from ..iterators.bitext import BiTextIterator
 from .basemodel import BaseModel
@@ -45,6 +47,9 @@ class Model(BaseModel):
         # Use a single embedding matrix for target words?
         self.tied_trg_emb = kwargs.get('tied_trg_emb', False)
 
+        # Ranks of the weights factorized by nmt-compress
+        self.svd_ranks = kwargs.get('svd_ranks', {})
+
         # Load dictionaries
         if 'src_dict' in kwargs:
             # Already passed through kwargs (nmt-translate)
@@ -86,138 +91,10 @@ class Model(BaseModel):
         self.set_dropout(False)
         self.logger = logger
 
-    @staticmethod
-    def beam_search(inputs, f_inits, f_nexts, beam_size=12, maxlen=50, suppress_unks=False, **kwargs):
-        # Final results and their scores
-        final_sample        = []
-        final_score         = []
-        final_alignments    = []
-
-        # Initially we have one empty hypothesis with a score of 0
-        hyp_alignments  = [[]]
-        hyp_samples     = [[]]
-        hyp_scores      = np.zeros(1, dtype=FLOAT)
-
-        # Number of models
-        n_models        = len(f_inits)
-
-        # Ensembling-aware lists
-        next_states     = [None] * n_models
-        text_ctxs       = [None] * n_models
-        aux_ctxs        = [[]] * n_models
-        tiled_ctxs      = [None] * n_models
-        next_log_ps     = [None] * n_models
-        alphas          = [None] * n_models
-
-        for i, f_init in enumerate(f_inits):
-            # Get next_state and initial contexts and save them
-            # text_ctx: the set of textual annotations
-            # aux_ctx: the set of auxiliary (ex: image) annotations
-            result = list(f_init(*inputs))
-            next_states[i], text_ctxs[i], aux_ctxs[i] = result[0], result[1], result[2:]
-            tiled_ctxs[i] = np.tile(text_ctxs[i], [1, 1])
-
-        # Beginning-of-sentence indicator is -1
-        next_w = -1 * np.ones((1,), dtype=INT)
-
-        # maxlen or 3 times source length
-        # NOTE: This will break if [0] is not the src sentence.
-        maxlen = min(maxlen, inputs[0].shape[0] * 3)
-
-        # Initial beam size
-        live_beam = beam_size
-
-        for t in range(maxlen):
-            # Get next states
-            # In the first iteration, we provide -1 and obtain the log_p's for the
-            # first word. In the following iterations tiled_ctx becomes a batch
-            # of duplicated left hypotheses. tiled_ctx is always the same except
-            # the size of the 2nd dimension as the context vectors of the source
-            # sequence is always the same regardless of the decoding process.
-            # next_state's shape is (live_beam, rnn_dim)
-
-            # We do this for each model
-            for m, f_next in enumerate(f_nexts):
-                next_log_ps[m], next_states[m], alphas[m] = f_next(*([next_w, next_states[m], tiled_ctxs[m]] + aux_ctxs[m]))
-
-                if suppress_unks:
-                    next_log_ps[m][:, 1] = -np.inf
-
-            # Compute sum of log_p's for the current hypotheses
-            cand_scores = hyp_scores[:, None] - sum(next_log_ps)
-
-            # Mean alphas for the mean model (n_models > 1)
-            mean_alphas = sum(alphas) / n_models
-
-            # Flatten by modifying .shape (faster)
-            cand_scores.shape = cand_scores.size
-
-            # Take the best live_beam hypotheses
-            # argpartition makes a partial sort which is faster than argsort
-            # (Idea taken from https://github.com/rsennrich/nematus)
-            ranks_flat = cand_scores.argpartition(live_beam-1)[:live_beam]
-
-            # Get the costs
-            costs = cand_scores[ranks_flat]
-
-            # New states, scores and samples
-            live_beam           = 0
-            new_hyp_scores      = []
-            new_hyp_samples     = []
-            new_hyp_alignments  = []
-
-            # This will be the new next states in the next iteration
-            hyp_states          = []
-
-            # Find out to which initial hypothesis idx this was belonging
-            # Find out the idx of the appended word
-            trans_idxs  = ranks_flat // next_log_ps[0].shape[1]
-            word_idxs   = ranks_flat % next_log_ps[0].shape[1]
-
-            # Iterate over the hypotheses and add them to new_* lists
-            for idx, [ti, wi] in enumerate(zip(trans_idxs, word_idxs)):
-                # Form the new hypothesis by appending new word to the left hyp
-                new_hyp = hyp_samples[ti] + [wi]
-                new_ali = hyp_alignments[ti] + [mean_alphas[ti]]
-
-                if wi == 0:
-                    # <eos> found, separate out finished hypotheses
-                    final_sample.append(new_hyp)
-                    final_score.append(costs[idx])
-                    final_alignments.append(new_ali)
-                else:
-                    # Add formed hypothesis to the new hypotheses list
-                    new_hyp_samples.append(new_hyp)
-                    # Cumulated cost of this hypothesis
-                    new_hyp_scores.append(costs[idx])
-                    new_hyp_alignments.append(new_ali)
-                    # Hidden state of the decoder for this hypothesis
-                    hyp_states.append([next_state[ti] for next_state in next_states])
-                    live_beam += 1
-
-            hyp_scores  = np.array(new_hyp_scores, dtype=FLOAT)
-            hyp_samples = new_hyp_samples
-            hyp_alignments = new_hyp_alignments
-
-            if live_beam == 0:
-                break
-
-            # Take the idxs of each hyp's last word
-            next_w      = np.array([w[-1] for w in hyp_samples])
-            next_states = [np.array(st, dtype=FLOAT) for st in zip(*hyp_states)]
-            tiled_ctxs  = [np.tile(ctx, [live_beam, 1]) for ctx in text_ctxs]
-
-        # dump every remaining hypotheses
-        for idx in range(live_beam):
-            final_sample.append(hyp_samples[idx])
-            final_score.append(hyp_scores[idx])
-            final_alignments.append(hyp_alignments[idx])
-
-        if not kwargs.get('get_att_alphas', False):
-            # Don't send back alignments for nothing
-            final_alignments = None
-
-        return final_sample, final_score, final_alignments
+    # Beam searches only use the samplers (see nmtpy.beamsearch)
+    beam_search         = staticmethod(beam_search)
+    batch_beam_search   = staticmethod(batch_beam_search)
+    speculative_search  = staticmethod(speculative_search)
 
     def info(self):
         self.logger.info('Source vocabulary size: %d', self.n_words_src)
@@ -226,15 +103,16 @@ class Model(BaseModel):
         self.logger.info('%d validation samples' % self.valid_iterator.n_samples)
         self.logger.info('dropout (emb,ctx,out): %.2f, %.2f, %.2f' % (self.emb_dropout, self.ctx_dropout, self.out_dropout))
 
-    def load_valid_data(self, from_translate=False):
+    def load_valid_data(self, from_translate=False, batch_size=1):
         self.valid_ref_files = self.data['valid_trg']
         if isinstance(self.valid_ref_files, str):
             self.valid_ref_files = list([self.valid_ref_files])
 
         if from_translate:
+            # Masks are only needed for batched decoding
             self.valid_iterator = TextIterator(
-                                    mask=False,
-                                    batch_size=1,
+                                    mask=batch_size > 1,
+                                    batch_size=batch_size,
                                     file=self.data['valid_src'], dict=self.src_dict,
                                     n_words=self.n_words_src)
         else:
@@ -314,7 +192,8 @@ class Model(BaseModel):
         if self.tied_trg_emb is False:
             params = get_new_layer('ff')[0](params, prefix='ff_logit'  , nin=self.embedding_dim , nout=self.n_words_trg, scale=self.weight_init)
 
-        self.initial_params = params
+        # Low-rank weights for fine-tuning a compressed model
+        self.initial_params = factorize_params(params, self.svd_ranks)
 
     def build(self):
         # description string: #words x #samples
@@ -338,13 +217,13 @@ class Model(BaseModel):
         n_samples = x.shape[1]
 
         # word embedding for forward rnn (source)
-        emb = dropout(self.tparams['Wemb_enc'][x.flatten()],
+        emb = dropout(weight_rows(self.tparams, 'Wemb_enc', x.flatten()),
                       self.trng, self.emb_dropout, self.use_dropout)
         emb = emb.reshape([n_timesteps, n_samples, self.embedding_dim])
         proj = get_new_layer(self.enc_type)[1](self.tparams, emb, prefix='encoder', mask=x_mask, layernorm=self.lnorm)
 
         # word embedding for backward rnn (source)
-        embr = dropout(self.tparams['Wemb_enc'][xr.flatten()],
+        embr = dropout(weight_rows(self.tparams, 'Wemb_enc', xr.flatten()),
                        self.trng, self.emb_dropout, self.use_dropout)
         embr = embr.reshape([n_timesteps, n_samples, self.embedding_dim])
         projr = get_new_layer(self.enc_type)[1](self.tparams, embr, prefix='encoder_r', mask=xr_mask, layernorm=self.lnorm)
@@ -372,7 +251,7 @@ class Model(BaseModel):
         # to the right. This is done because of the bi-gram connections in the
         # readout and decoder rnn. The first target will be all zeros and we will
         # not condition on the last output.
-        emb = self.tparams['Wemb_dec'][y.flatten()]
+        emb = weight_rows(self.tparams, 'Wemb_dec', y.flatten())
         emb = emb.reshape([n_timesteps_trg, n_samples, self.embedding_dim])
         emb_shifted = tensor.zeros_like(emb)
         emb_shifted = tensor.set_subtensor(emb_shifted[1:], emb[:-1])
@@ -404,7 +283,7 @@ class Model(BaseModel):
         if self.tied_trg_emb is False:
             logit = get_new_layer('ff')[1](self.tparams, logit, prefix='ff_logit', activ='linear')
         else:
-            logit = tensor.dot(logit, self.tparams['Wemb_dec'].T)
+            logit = weight_dot_t(self.tparams, logit, 'Wemb_dec')
 
         logit_shp = logit.shape
 
@@ -425,22 +304,30 @@ class Model(BaseModel):
 
         return cost
 
-    def build_sampler(self):
-        x           = tensor.matrix('x', dtype=INT)
+    def sampler_init_graph(self, x, x_mask=None):
+        """Build the encoder graph of the sampler.
+
+        Returns the symbolic initial decoder state, the source annotations
+        and their projection for the attention. x_mask is given for padded
+        minibatches of sentences."""
         xr          = x[::-1]
         n_timesteps = x.shape[0]
         n_samples   = x.shape[1]
 
+        # Padded minibatches of sentences need the source mask
+        # for the encoder, the initial state and the attention.
+        xr_mask = None if x_mask is None else x_mask[::-1]
+
         # word embedding (source), forward and backward
-        emb = self.tparams['Wemb_enc'][x.flatten()]
+        emb = weight_rows(self.tparams, 'Wemb_enc', x.flatten())
         emb = emb.reshape([n_timesteps, n_samples, self.embedding_dim])
 
-        embr = self.tparams['Wemb_enc'][xr.flatten()]
+        embr = weight_rows(self.tparams, 'Wemb_enc', xr.flatten())
         embr = embr.reshape([n_timesteps, n_samples, self.embedding_dim])
 
         # encoder
-        proj = get_new_layer(self.enc_type)[1](self.tparams, emb, prefix='encoder', layernorm=self.lnorm)
-        projr = get_new_layer(self.enc_type)[1](self.tparams, embr, prefix='encoder_r', layernorm=self.lnorm)
+        proj = get_new_layer(self.enc_type)[1](self.tparams, emb, prefix='encoder', mask=x_mask, layernorm=self.lnorm)
+        projr = get_new_layer(self.enc_type)[1](self.tparams, embr, prefix='encoder_r', mask=xr_mask, layernorm=self.lnorm)
 
         # concatenate forward and backward rnn hidden states
         ctx = [tensor.concatenate([proj[0], projr[0][::-1]], axis=proj[0].ndim-1)]
@@ -448,29 +335,47 @@ class Model(BaseModel):
         for i in range(1, self.n_enc_layers):
             ctx = get_new_layer(self.enc_type)[1](self.tparams, ctx[0],
                                                   prefix='deepencoder_%d' % i,
-                                                  layernorm=self.lnorm)
+                                                  mask=x_mask, layernorm=self.lnorm)
 
         ctx = ctx[0]
 
-        if self.init_cgru == 'text' and 'ff_state_W' in self.tparams:
+        if self.init_cgru == 'text' and 'ff_state_b' in self.tparams:
             # get the input for decoder rnn initializer mlp
-            ctx_mean = ctx.mean(0)
+            if x_mask is not None:
+                ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+            else:
+                ctx_mean = ctx.mean(0)
             init_state = get_new_layer('ff')[1](self.tparams, ctx_mean, prefix='ff_state', activ='tanh')
         else:
             # assume zero-initialized decoder
             init_state = tensor.alloc(0., n_samples, self.rnn_dim)
 
-        outs = [init_state, ctx]
-        self.f_init = theano.function([x], outs, name='f_init')
+        # Project the context for the attention once per sentence
+        # instead of recomputing it in every f_next call
+        pctx = tensor.dot(ctx, self.tparams['decoder_Wc_att']) + self.tparams['decoder_b_att']
 
-        # x: 1 x 1
-        y = tensor.vector('y_sampler', dtype=INT)
-        init_state = tensor.matrix('init_state', dtype=FLOAT)
+        return init_state, ctx, pctx
 
+    def sampler_next_graph(self, y, init_state, ctx, pctx, x_mask=None, vocab=None):
+        """Build the graph of one decoding step of the sampler.
+
+        Returns the symbolic log-probabilities of the next words (only for
+        the target words in vocab if given), the next decoder state, the
+        attention weights and the readout before the output layer."""
         # if it's the first word, emb should be all zero and it is indicated by -1
         emb = tensor.switch(y[:, None] < 0,
-                            tensor.alloc(0., 1, self.tparams['Wemb_dec'].shape[1]),
-                            self.tparams['Wemb_dec'][y])
+                            tensor.alloc(0., 1, self.embedding_dim),
+                            weight_rows(self.tparams, 'Wemb_dec', y))
+
+        # Linear transformations of emb are replaced by gathers from
+        # vocabulary-indexed tables if the model has them (nmt-precompute)
+        def lookup(table, bias):
+            if table not in self.tparams:
+                return None
+            # Only the bias remains for the zero embedding of the first word
+            return tensor.switch(y[:, None] < 0,
+                                 self.tparams[bias][None, :],
+                                 self.tparams[table][y])
 
         # apply one step of conditional gru with attention
         # get the next hidden states
@@ -478,23 +383,38 @@ class Model(BaseModel):
         r = get_new_layer('gru_cond')[1](self.tparams, emb,
                                          prefix='decoder',
                                          mask=None, context=ctx,
+                                         context_mask=x_mask,
                                          one_step=True,
-                                         init_state=init_state, layernorm=False)
+                                         init_state=init_state, layernorm=False,
+                                         pctx=pctx,
+                                         state_below_=lookup('decoder_W_table', 'decoder_b'),
+                                         state_belowx=lookup('decoder_Wx_table', 'decoder_bx'))
 
         next_state = r[0]
         ctxs = r[1]
         alphas = r[2]
 
-        logit_prev = get_new_layer('ff')[1](self.tparams, emb,          prefix='ff_logit_prev',activ='linear')
+        logit_prev = lookup('ff_logit_prev_table', 'ff_logit_prev_b')
+        if logit_prev is None:
+            logit_prev = get_new_layer('ff')[1](self.tparams, emb,      prefix='ff_logit_prev',activ='linear')
         logit_ctx  = get_new_layer('ff')[1](self.tparams, ctxs,         prefix='ff_logit_ctx', activ='linear')
         logit_gru  = get_new_layer('ff')[1](self.tparams, next_state,   prefix='ff_logit_gru', activ='linear')
 
         logit = tanh(logit_gru + logit_prev + logit_ctx)
 
-        if self.tied_trg_emb is False:
+        # Readout for the approximate output layer in nmtpy.mips
+        readout = logit
+
+        if vocab is not None:
+            # Compute the logits only for the given target words
+            if self.tied_trg_emb is False:
+                logit = weight_dot(self.tparams, logit, 'ff_logit_W', vocab) + self.tparams['ff_logit_b'][vocab]
+            else:
+                logit = weight_dot_t(self.tparams, logit, 'Wemb_dec', vocab)
+        elif self.tied_trg_emb is False:
             logit = get_new_layer('ff')[1](self.tparams, logit, prefix='ff_logit', activ='linear')
         else:
-            logit = tensor.dot(logit, self.tparams['Wemb_dec'].T)
+            logit = weight_dot_t(self.tparams, logit, 'Wemb_dec')
 
         # compute the logsoftmax
         next_log_probs = tensor.nnet.logsoftmax(logit)
@@ -505,9 +425,155 @@ class Model(BaseModel):
         #next_probs = tensor.exp(next_log_probs)
         #next_word = self.trng.multinomial(pvals=next_probs).argmax(1)
 
+        return next_log_probs, next_state, alphas, readout
+
+    def build_sampler(self, batched=False, get_att_alphas=True, shortlist=False,
+                      approx_clusters=0, approx_nbest=16):
+        x       = tensor.matrix('x', dtype=INT)
+        x_mask  = tensor.matrix('x_mask', dtype=FLOAT) if batched else None
+
+        init_state, ctx, pctx = self.sampler_init_graph(x, x_mask)
+
+        if batched:
+            # The mask is given back to f_next along with the contexts
+            self.f_init = theano.function([x, x_mask], [init_state, ctx, pctx, x_mask], name='f_init')
+        else:
+            self.f_init = theano.function([x], [init_state, ctx, pctx], name='f_init')
+
+        # x: 1 x 1
+        y           = tensor.vector('y_sampler', dtype=INT)
+        init_state  = tensor.matrix('init_state', dtype=FLOAT)
+        ctx         = tensor.tensor3('ctx', dtype=FLOAT)
+        pctx        = tensor.tensor3('pctx', dtype=FLOAT)
+        vocab       = tensor.vector('vocab', dtype=INT) if shortlist else None
+
+        if not batched:
+            # pctx is given untiled to f_next and broadcasted over the beam
+            pctx = tensor.addbroadcast(pctx, 1)
+
+        next_log_probs, next_state, alphas, readout = \
+            self.sampler_next_graph(y, init_state, ctx, pctx, x_mask, vocab)
+
         # compile a function to do the whole thing above
         # next hidden state to be used
-        inputs = [y, init_state, ctx]
-
-        outs = [next_log_probs, next_state, alphas]
+        inputs = [y, init_state, ctx, pctx]
+        if batched:
+            inputs.append(x_mask)
+        if shortlist:
+            inputs.append(vocab)
+
+        outs = [next_log_probs, next_state]
+        if approx_clusters > 0:
+            # The output layer is approximated outside of the graph
+            outs[0] = readout
+        if get_att_alphas:
+            # Lean samplers skip returning the attention weights
+            outs.append(alphas)
         self.f_next = theano.function(inputs, outs, name='f_next')
+
+        if approx_clusters > 0:
+            params = dict([(k, v.get_value()) for k, v in self.tparams.items()])
+            if self.tied_trg_emb is False:
+                W, b = get_weight(params, 'ff_logit_W'), params['ff_logit_b']
+            else:
+                W = get_weight(params, 'Wemb_dec').T
+                b = np.zeros((W.shape[1], ), dtype=FLOAT)
+            self.f_next = ClusteredSoftmax(W, b, approx_clusters, approx_nbest).wrap(self.f_next)
+
+    def build_verifier(self):
+        """Compile f_verify for speculative_search().
+
+        f_verify feeds the words y (n_steps x n_samples) to the decoder
+        starting from init_state and returns the log-probabilities and
+        the decoder states after each step. Like f_log_probs, the output
+        layer is computed for all the steps at once."""
+        y           = tensor.matrix('y_verify', dtype=INT)
+        init_state  = tensor.matrix('init_state', dtype=FLOAT)
+        ctx         = tensor.tensor3('ctx', dtype=FLOAT)
+        pctx        = tensor.tensor3('pctx', dtype=FLOAT)
+
+        # pctx is given untiled and broadcasted over the samples
+        pctx = tensor.addbroadcast(pctx, 1)
+
+        def _step(y_, h_, ctx_, pctx_):
+            # The output layer of each step is left out of the loop
+            _, next_state, _, readout = self.sampler_next_graph(y_, h_, ctx_, pctx_)
+            return next_state, readout
+
+        (states, readouts), _ = theano.scan(_step,
+                                            sequences=[y],
+                                            outputs_info=[init_state, None],
+                                            non_sequences=[ctx, pctx])
+
+        n_steps, n_samples = readouts.shape[0], readouts.shape[1]
+        readouts = readouts.reshape([n_steps * n_samples, readouts.shape[2]])
+
+        if self.tied_trg_emb is False:
+            logit = get_new_layer('ff')[1](self.tparams, readouts, prefix='ff_logit', activ='linear')
+        else:
+            logit = weight_dot_t(self.tparams, readouts, 'Wemb_dec')
+
+        log_probs = tensor.nnet.logsoftmax(logit).reshape([n_steps, n_samples, logit.shape[1]])
+
+        self.f_verify = theano.function([y, init_state, ctx, pctx], [log_probs, states], name='f_verify')
+
+    @staticmethod
+    def build_fused_sampler(models, batched=False, get_att_alphas=True, shortlist=False):
+        """Compile a single f_init/f_next pair computing all ensemble members.
+
+        Initial states, contexts and projected contexts of the members are
+        concatenated on their last axis so that beam search handles the
+        ensemble as a single model with one Theano call per step. f_next
+        returns the sum of the members' log-probabilities, as beam search
+        does for separate models, and their mean attention weights. Returns
+        None if a member does not use this sampler."""
+        if any([type(m).build_sampler is not Model.build_sampler for m in models]):
+            return None
+
+        x       = tensor.matrix('x', dtype=INT)
+        x_mask  = tensor.matrix('x_mask', dtype=FLOAT) if batched else None
+
+        init_states, ctxs, pctxs = zip(*[m.sampler_init_graph(x, x_mask) for m in models])
+        outs = [tensor.concatenate(init_states, axis=1),
+                tensor.concatenate(ctxs, axis=2),
+                tensor.concatenate(pctxs, axis=2)]
+
+        if batched:
+            f_init = theano.function([x, x_mask], outs + [x_mask], name='f_init_fused')
+        else:
+            f_init = theano.function([x], outs, name='f_init_fused')
+
+        y           = tensor.vector('y_sampler', dtype=INT)
+        init_state  = tensor.matrix('init_state', dtype=FLOAT)
+        ctx         = tensor.tensor3('ctx', dtype=FLOAT)
+        pctx        = tensor.tensor3('pctx', dtype=FLOAT)
+        vocab       = tensor.vector('vocab', dtype=INT) if shortlist else None
+
+        if not batched:
+            pctx = tensor.addbroadcast(pctx, 1)
+
+        # Offsets of each member's slices
+        state_offsets   = np.cumsum([0] + [m.rnn_dim for m in models])
+        ctx_offsets     = np.cumsum([0] + [m.ctx_dim for m in models])
+
+        log_probs, next_states, alphas = [], [], []
+        for i, m in enumerate(models):
+            s0, s1 = state_offsets[i], state_offsets[i + 1]
+            c0, c1 = ctx_offsets[i], ctx_offsets[i + 1]
+            r = m.sampler_next_graph(y, init_state[:, s0:s1], ctx[:, :, c0:c1], pctx[:, :, c0:c1], x_mask, vocab)
+            log_probs.append(r[0])
+            next_states.append(r[1])
+            alphas.append(r[2])
+
+        inputs = [y, init_state, ctx, pctx]
+        if batched:
+            inputs.append(x_mask)
+        if shortlist:
+            inputs.append(vocab)
+
+        outs = [sum(log_probs), tensor.concatenate(next_states, axis=1)]
+        if get_att_alphas:
+            outs.append(sum(alphas) / len(models))
+        f_next = theano.function(inputs, outs, name='f_next_fused')
+
+        return f_init, f_next
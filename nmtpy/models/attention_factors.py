@@ -14,6 +14,7 @@ import theano.tensor as tensor
 # Ours
 from ..layers import *
 from ..defaults import INT, FLOAT
+from ..beamsearch import BeamHistory, top_factored_candidates
 from ..nmtutils import *
 from ..iterators.text import TextIterator
 from ..iterators.bitext import BiTextIterator
@@ -106,8 +107,9 @@ class Model(BaseModel):
         self.set_dropout(False)
         self.logger = logger
     
-    def run_beam_search(self, beam_size=12, n_jobs=8, metric='bleu', mode='beamsearch', valid_mode='single', f_valid_out=None):
+    def run_beam_search(self, beam_size=12, n_jobs=8, metric='bleu', mode='beamsearch', valid_mode='single', f_valid_out=None, numpy=False):
         """Save model under /tmp for passing it to nmt-translate-factors."""
+        # NOTE: There are no NumPy samplers for factored models, numpy is ignored.
         # Save model temporarily
         with get_temp_file(suffix=".npz", delete=True) as tmpf:
             self.save(tmpf.name)
@@ -133,229 +135,221 @@ class Model(BaseModel):
 
         return result[metric]
 
+    @staticmethod
+    def split_factored_hyps(hyps):
+        """Split (samples, scores, alignments) of BeamHistory.get_hyps()
+        into (lemma samples, scores, alignments, factor samples)."""
+        samples, scores, alignments = hyps
+        samples_lem = [[tok[0] for tok in sample] for sample in samples]
+        samples_fact = [[tok[1] for tok in sample] for sample in samples]
+        return samples_lem, scores, alignments, samples_fact
+
     @staticmethod
     def beam_search(inputs, f_inits, f_nexts, beam_size=12, maxlen=50, suppress_unks=False, **kwargs):
-            #TODO ensamble
-            # Final results and their scores
-            final_sample_lem = []
-            final_score_lem = []
-            final_sample_fact = []
-            final_score_fact = []
-            final_alignments = []
-
-            # Initially we have one empty hypothesis with a score of 0
-            hyp_scores  = np.zeros(1).astype(FLOAT)
-            hyp_scores_lem  = np.zeros(1).astype(FLOAT)
-            hyp_scores_fact  = np.zeros(1).astype(FLOAT)
-            hyp_samples_lem = [[]]
-            hyp_samples_fact = [[]]
-            hyp_alignments  = [[]]
-
-            # get initial state of decoder rnn and encoder context vectors
-            # ctx0: the set of context vectors leading to the next_state
-            # with a shape of (n_words x 1 x ctx_dim)
-            # next_state: mean context vector (ctx0.mean()) passed through FF with a final
-            # shape of (1 x 1 x ctx_dim)
-            # The 2 outputs have the same next_state
-            next_state, ctx0 = f_inits[0](inputs[0])
-
-            # Beginning-of-sentence indicator is -1
-            next_w_lem = -1 * np.ones((1,)).astype(INT)
-            next_w_fact = -1 * np.ones((1,)).astype(INT)
-
-            # maxlen or 3 times source length
-            #maxlen = min(maxlen, inputs[0].shape[0] * 3)
-            maxlen = inputs[0].shape[0] * 3
-
-            # Always starts with the initial tstep's context vectors
-            # e.g. we have a ctx0 of shape (n_words x 1 x ctx_dim)
-            # Tiling it live_beam times makes it (n_words x live_beam x ctx_dim)
-            # thus we create sth like a batch of live_beam size with every word duplicated
-            # for further state expansion.
-            tiled_ctx = np.tile(ctx0, [1, 1])
-            live_beam = beam_size
-
-            for ii in range(maxlen):
-                # Always starts with the initial tstep's context vectors
-                # e.g. we have a ctx0 of shape (n_words x 1 x ctx_dim)
-                # Tiling it live_beam times makes it (n_words x live_beam x ctx_dim)
-                # thus we create sth like a batch of live_beam size with every word duplicated
-                # for further state expansion.
-
-                # Get next states
-                # In the first iteration, we provide -1 and obtain the log_p's for the
-                # first word. In the following iterations tiled_ctx becomes a batch
-                # of duplicated left hypotheses. tiled_ctx is always the same except
-                # the 2nd dimension as the context vectors of the source sequence
-                # is always the same regardless of the decoding step.
-                next_log_p_lem, _, next_log_p_fact, _, next_state, alphas = f_nexts[0](*[next_w_lem, next_w_fact, tiled_ctx, next_state])
-                # For each f_next, we obtain a new set of alpha's for the next_w
-                # for each hypothesis in the beam search
+        """Beam search over (lemma, factor) pairs.
+
+        The cost of a hypothesis is the sum of its lemma and factor
+        log-probabilities and it is finished when the lemma is <eos>.
+        Returns the lemma samples, scores, alignments and factor samples."""
+        # Number of models
+        n_models        = len(f_inits)
+
+        # Ensembling-aware lists
+        next_states     = [None] * n_models
+        text_ctxs       = [None] * n_models
+        aux_ctxs        = [[]] * n_models
+        tiled_ctxs      = [None] * n_models
+        next_log_ps_lem = [None] * n_models
+        next_log_ps_fact= [None] * n_models
+        alphas          = [None] * n_models
+
+        for i, f_init in enumerate(f_inits):
+            result = list(f_init(*inputs))
+            next_states[i], text_ctxs[i], aux_ctxs[i] = result[0], result[1], result[2:]
+            tiled_ctxs[i] = text_ctxs[i]
+
+        # Beginning-of-sentence indicator is -1
+        next_w_lem = -1 * np.ones((1,), dtype=INT)
+        next_w_fact = -1 * np.ones((1,), dtype=INT)
+
+        # maxlen or 3 times source length
+        # NOTE: This will break if [0] is not the src sentence.
+        maxlen = min(maxlen, inputs[0].shape[0] * 3)
+
+        # (lemma, factor) pairs, backpointers, scores (and alignments)
+        track_alphas = kwargs.get('get_att_alphas', False)
+        beam = BeamHistory(maxlen, beam_size, n_outputs=2, track_alphas=track_alphas)
+
+        # Initially we have one empty hypothesis with a score of 0
+        hyp_scores  = np.zeros(1, dtype=FLOAT)
+        live_slots  = np.zeros(1, dtype=INT)
+        live_beam   = 1
+
+        for t in range(maxlen):
+            for m, f_next in enumerate(f_nexts):
+                result = f_next(*([next_w_lem, next_w_fact, next_states[m], tiled_ctxs[m]] + aux_ctxs[m]))
+                next_log_ps_lem[m], next_log_ps_fact[m], next_states[m] = result[:3]
+                if track_alphas:
+                    alphas[m] = result[3]
 
                 if suppress_unks:
-                    next_log_p_lem[:, 1] = -np.inf
-
-
-                # Compute sum of log_p's for the current n-gram hypotheses and flatten them
-                cand_scores_lem = hyp_scores_lem[:, None] - next_log_p_lem
-                cand_scores_fact = hyp_scores_fact[:, None] - next_log_p_fact
-                
-                # Beam search improvement for factors
-                # Do combination for each new hyp
-                cand_costs = []
-                cand_costs_lem = []
-                cand_costs_fact = []
-                cand_w_idx = []
-                cand_trans_idx = []
-                for idx, [cand_h_scores_lem, cand_h_scores_fact] in enumerate(zip(cand_scores_lem, cand_scores_fact)):
-                    # Take the best beam_size-dead_beam hypotheses
-                    ranks_lem = cand_h_scores_lem.argpartition(live_beam-1)[:live_beam]
-                    # if beam size if bigger than factors vocab, use vocab size as beam size for it
-                    #if live_beam > self.n_words_trgmult:
-                    if live_beam > next_log_p_fact.shape[1]:
-                        #ranks_fact = cand_h_scores_fact.argpartition(self.n_words_trgmult-1)[:self.n_words_trgmult]
-                        ranks_fact = cand_h_scores_fact.argpartition(next_log_p_fact,shape[1]-1)[:next_log_p_fact.shape[1]]
-                    else:
-                        ranks_fact = cand_h_scores_fact.argpartition(live_beam-1)[:live_beam]
-                    # Get their costs
-                    costs_h_lem = cand_h_scores_lem[ranks_lem]
-                    costs_h_fact = cand_h_scores_fact[ranks_fact]
-                    #word_indices_lem = ranks_lem % self.n_words_trg
-                    word_indices_lem = ranks_lem % next_log_p_lem.shape[1]
-                    #word_indices_fact = ranks_fact % self.n_words_trgmult
-                    word_indices_fact = ranks_fact % next_log_p_fact.shape[1]
-                    
-                    # Sum the logp's of lemmas and factors and keep the best ones
-                    cand_h_costs = []
-                    cand_h_costs_lem = []
-                    cand_h_costs_fact = []
-                    cand_h_w_idx = []
-                    for l in range(live_beam):
-                        #if live_beam > self.n_words_trgmult:
-                        if live_beam > next_log_p_fact.shape[1]:
-                            #for f in range(self.n_words_trgmult):
-                            for f in range(next_log_p_fact.shape[1]):
-                                cand_h_costs.append(costs_h_lem[l]+ costs_h_fact[f])
-                                cand_h_costs_lem.append(costs_h_lem[l])
-                                cand_h_costs_fact.append(costs_h_fact[f])
-                                # keep the word indexes of both outputs
-                                cand_h_w_idx.append([word_indices_lem[l], word_indices_fact[f]])
-                        else:
-                            for f in range(live_beam):
-                                cand_h_costs.append(costs_h_lem[l]+ costs_h_fact[f])
-                                cand_h_costs_lem.append(costs_h_lem[l])
-                                cand_h_costs_fact.append(costs_h_fact[f])
-                                # keep the word indexes of both outputs
-                                cand_h_w_idx.append([word_indices_lem[l], word_indices_fact[f]])
-                    # We convert the merged lists to np arrays and prune with the best costs and get indices of the nbest
-                    cand_h_costs = np.array(cand_h_costs)
-                    cand_h_costs_lem = np.array(cand_h_costs_lem)
-                    cand_h_costs_fact = np.array(cand_h_costs_fact)
-                    cand_h_w_idx = np.array(cand_h_w_idx)
-                    ranks_h_costs = cand_h_costs.argsort()[:(live_beam)]
-                    
-                    # We append the beam_size hyps
-                    cand_costs.append(cand_h_costs[ranks_h_costs])
-                    cand_costs_lem.append(cand_h_costs_lem[ranks_h_costs])
-                    cand_costs_fact.append(cand_h_costs_fact[ranks_h_costs])
-                    word_h_indices = cand_h_w_idx[ranks_h_costs]
-                    # We cannot flatten later this array, we need pair elements
-                    for w in word_h_indices:
-                        cand_w_idx.append(w)
-                    trans_h_indices = []
-                    trans_h_indices = live_beam * [idx]
-                    trans_h_indices = np.array(trans_h_indices)
-                    cand_trans_idx.append(trans_h_indices)
-
-                # We convert the merged lists to np arrays and prune with the best costs and get indices of the nbest
-                cand_costs = np.array(cand_costs)
-                cand_costs_lem = np.array(cand_costs_lem)
-                cand_costs_fact = np.array(cand_costs_fact)
-                cand_w_idx = np.array(cand_w_idx)
-                cand_trans_idx = np.array(cand_trans_idx)
-                cand_flat_costs = cand_costs.flatten()
-                cand_flat_costs_lem = cand_costs_lem.flatten()
-                cand_flat_costs_fact = cand_costs_fact.flatten()
-                ranks_costs = cand_flat_costs.argsort()[:(live_beam)]
-                costs = cand_flat_costs[ranks_costs]
-                costs_lem = cand_flat_costs_lem[ranks_costs]
-                costs_fact = cand_flat_costs_fact[ranks_costs]
-                word_indices = cand_w_idx[ranks_costs]
-                cand_trans_idx_flat = cand_trans_idx.flatten()
-                trans_indices = cand_trans_idx_flat[ranks_costs]
-
-
-                # New states, scores and samples
-                live_beam = 0
-                # We have shared scores for both outputs after the last pruning
-                new_hyp_scores = []
-                new_hyp_samples_lem = []
-                new_hyp_scores_lem = []
-                new_hyp_samples_fact = []
-                # Using the EOS of lemmas for factors
-                new_hyp_scores_fact = []
-                new_hyp_alignments  = []
-
-                # This will be the new next states in the next iteration
-                hyp_states = []
-
-                # Iterate over the hypotheses and add them to new_* lists
-                # We have common next_state
-                for idx, [wi, ti] in enumerate(zip(word_indices, trans_indices)):
-                    # Form the new hypothesis by appending new word to the left hyp
-                    new_hyp_lem = hyp_samples_lem[ti] + [wi[0]]
-                    new_hyp_fact = hyp_samples_fact[ti] + [wi[1]]
-                    new_ali = hyp_alignments[ti] + [alphas[ti]]
-                    if wi[0] == 0:
-                        # <eos> found in lemmas, separate out finished hypotheses
-                        final_sample_lem.append(new_hyp_lem)
-                        final_score_lem.append(costs_lem[idx])
-                        #final_sample_fact.append(new_hyp_fact)
-                        final_sample_fact.append(hyp_samples_fact[ti])
-                        final_score_fact.append(costs_fact[idx])
-                        final_alignments.append(new_ali)
-                    else:
-                        # Add formed hypothesis to the new hypotheses list
-                        new_hyp_scores_lem.append(costs_lem[idx])
-                        new_hyp_scores_fact.append(costs_fact[idx])
-                        # We get the same state from lemmas and factors
-                        hyp_states.append(next_state[ti])
-                        # first position is the lemma and the second the factors
-                        new_hyp_samples_lem.append(new_hyp_lem)
-                        new_hyp_samples_fact.append(new_hyp_fact)
-                        new_hyp_alignments.append(new_ali)
-                        live_beam += 1
-
-
-                hyp_scores_lem  = np.array(new_hyp_scores_lem, dtype=FLOAT)
-                hyp_scores_fact = np.array(new_hyp_scores_fact, dtype=FLOAT)
-                hyp_samples_lem = new_hyp_samples_lem
-                hyp_samples_fact = new_hyp_samples_fact
-                hyp_alignments = new_hyp_alignments
-
-                if live_beam == 0:
-                    break
-
-                # Take the idxs of each hyp's last word
-                next_w_lem = np.array([w[-1] for w in hyp_samples_lem])
-                next_w_fact = np.array([w[-1] for w in hyp_samples_fact])
-                next_state = np.array(hyp_states, dtype=FLOAT)
-                tiled_ctx   = np.tile(ctx0, [live_beam, 1])
-
-            # dump every remaining hypotheses
-            #if live_beam > 0:
-            for idx in range(live_beam):
-                final_score_lem.append(hyp_scores_lem[idx])
-                final_sample_lem.append(hyp_samples_lem[idx])
-                final_sample_fact.append(hyp_samples_fact[idx])
-                final_score_fact.append(hyp_scores_fact[idx])
-                final_alignments.append(hyp_alignments[idx])
-
-            final_score = []
-            for b in range(beam_size):
-                final_score.append(final_score_lem[b] + final_score_fact[b])
-
-            return final_sample_lem, final_score, final_alignments, final_sample_fact
+                    next_log_ps_lem[m][:, 1] = -np.inf
+
+            # Take the best expansions to fill the beam
+            n_open = beam_size - len(beam.finished)
+            trans_idxs, lems, facts, costs = top_factored_candidates(
+                hyp_scores, sum(next_log_ps_lem), sum(next_log_ps_fact), n_open)
+
+            # Factors of finished hypotheses are not part of their output
+            facts[lems == 0] = 0
+
+            # Store new hypotheses along with pointers to their parents' slots
+            # Mean alphas for the mean model (n_models > 1)
+            beam.add(t, np.stack([lems, facts], axis=1), live_slots[trans_idxs], costs,
+                     (sum(alphas) / n_models)[trans_idxs] if track_alphas else None)
+
+            # <eos> found in lemmas, separate out finished hypotheses
+            is_eos = lems == 0
+            beam.finish(t, np.nonzero(is_eos)[0])
+
+            live_slots  = np.nonzero(~is_eos)[0]
+            live_beam   = live_slots.size
+            if live_beam == 0:
+                break
+
+            # Scores, last words and decoder states of the live hypotheses
+            hyp_scores  = costs[live_slots]
+            next_w_lem  = lems[live_slots]
+            next_w_fact = facts[live_slots]
+            trans_idxs  = trans_idxs[live_slots]
+            next_states = [st[trans_idxs] for st in next_states]
+            tiled_ctxs  = [np.tile(ctx, [live_beam, 1]) for ctx in text_ctxs]
+
+        # dump every remaining hypotheses
+        beam.finish(t, live_slots)
+
+        return Model.split_factored_hyps(beam.get_hyps())
+
+    @staticmethod
+    def batch_beam_search(inputs, f_inits, f_nexts, beam_size=12, maxlen=50, suppress_unks=False, **kwargs):
+        """Factored beam search over a padded minibatch of source sentences.
+
+        f_init/f_next should come from build_sampler(batched=True). The live
+        hypotheses of all sentences are stacked into a single f_next call
+        per model while each sentence keeps its own beam. Returns a list of
+        beam_search() results, one per source sentence."""
+        # Number of models
+        n_models        = len(f_inits)
+
+        # Ensembling-aware lists
+        next_states     = [None] * n_models
+        ctxs            = [None] * n_models
+        next_log_ps_lem = [None] * n_models
+        next_log_ps_fact= [None] * n_models
+        alphas          = [None] * n_models
+
+        for i, f_init in enumerate(f_inits):
+            result = list(f_init(*inputs))
+            next_states[i], ctxs[i] = result[0], result[1:]
+
+        # Source lengths including <eos>
+        # NOTE: This will break if [1] is not the source mask.
+        src_lens        = inputs[1].sum(0).astype(INT)
+        n_sents         = src_lens.size
+
+        # maxlen or 3 times source length
+        maxlens         = np.minimum(maxlen, src_lens * 3)
+
+        # Separate history for each sentence
+        track_alphas    = kwargs.get('get_att_alphas', False)
+        beams           = [BeamHistory(maxlens[s], beam_size, n_outputs=2, track_alphas=track_alphas) for s in range(n_sents)]
+
+        # Initially each sentence has one empty hypothesis with a score of 0
+        hyp_scores      = [np.zeros(1, dtype=FLOAT) for _ in range(n_sents)]
+        live_slots      = [np.zeros(1, dtype=INT) for _ in range(n_sents)]
+
+        # Source sentence of each row given to f_next
+        hyp_sents       = np.arange(n_sents)
+
+        # Beginning-of-sentence indicator is -1
+        next_w_lem      = -1 * np.ones((n_sents,), dtype=INT)
+        next_w_fact     = -1 * np.ones((n_sents,), dtype=INT)
+        tiled_ctxs      = ctxs
+
+        for t in range(maxlens.max()):
+            for m, f_next in enumerate(f_nexts):
+                result = f_next(*([next_w_lem, next_w_fact, next_states[m]] + tiled_ctxs[m]))
+                next_log_ps_lem[m], next_log_ps_fact[m], next_states[m] = result[:3]
+                if track_alphas:
+                    alphas[m] = result[3]
+
+                if suppress_unks:
+                    next_log_ps_lem[m][:, 1] = -np.inf
+
+            # Sum of log_p's and mean alphas for the mean model (n_models > 1)
+            sum_log_ps_lem  = sum(next_log_ps_lem)
+            sum_log_ps_fact = sum(next_log_ps_fact)
+            mean_alphas     = sum(alphas) / n_models if track_alphas else None
+
+            # Rows and last words of the surviving hypotheses
+            new_rows, new_lems, new_facts = [], [], []
+
+            # Offset of the current sentence's rows
+            offset = 0
+
+            for s in range(n_sents):
+                n_hyps = live_slots[s].size
+                if n_hyps == 0:
+                    # This sentence is already finished
+                    continue
+
+                # Take the best expansions to fill the beam of this sentence
+                n_open = beam_size - len(beams[s].finished)
+                parents, lems, facts, costs = top_factored_candidates(
+                    hyp_scores[s], sum_log_ps_lem[offset:offset + n_hyps],
+                    sum_log_ps_fact[offset:offset + n_hyps], n_open)
+                rows = offset + parents
+
+                # Factors of finished hypotheses are not part of their output
+                facts[lems == 0] = 0
+
+                # Drop the attention over padded source positions
+                beams[s].add(t, np.stack([lems, facts], axis=1), live_slots[s][parents], costs,
+                             mean_alphas[rows, :src_lens[s]] if track_alphas else None)
+
+                is_eos = lems == 0
+                if t + 1 == maxlens[s]:
+                    # Reached maxlen for this sentence, every hypothesis will be dumped
+                    is_eos[:] = True
+
+                # <eos> found in lemmas, separate out finished hypotheses
+                beams[s].finish(t, np.nonzero(is_eos)[0])
+
+                live_slots[s]   = np.nonzero(~is_eos)[0]
+                hyp_scores[s]   = costs[live_slots[s]]
+
+                new_rows.append(rows[live_slots[s]])
+                new_lems.append(lems[live_slots[s]])
+                new_facts.append(facts[live_slots[s]])
+
+                offset += n_hyps
+
+            new_rows = np.concatenate(new_rows)
+            if new_rows.size == 0:
+                break
+
+            # Gather the last words and states of the live hypotheses at once
+            next_w_lem  = np.concatenate(new_lems)
+            next_w_fact = np.concatenate(new_facts)
+            next_states = [st[new_rows] for st in next_states]
+
+            # Gather the contexts of the live hypotheses only if the layout changed
+            new_sents   = np.repeat(np.arange(n_sents), [ls.size for ls in live_slots])
+            if not np.array_equal(new_sents, hyp_sents):
+                hyp_sents   = new_sents
+                tiled_ctxs  = [[c[:, hyp_sents] for c in ctx] for ctx in ctxs]
+
+        return [Model.split_factored_hyps(beam.get_hyps()) for beam in beams]
 
     def info(self):
         self.logger.info('Source vocabulary size: %d', self.n_words_src)
@@ -365,15 +359,16 @@ class Model(BaseModel):
         self.logger.info('%d validation samples' % self.valid_iterator.n_samples)
         self.logger.info('dropout (emb,ctx,out): %.2f, %.2f, %.2f' % (self.emb_dropout, self.ctx_dropout, self.out_dropout))
 
-    def load_valid_data(self, from_translate=False):
+    def load_valid_data(self, from_translate=False, batch_size=1):
         self.valid_ref_files = self.data['valid_trg']
         if isinstance(self.valid_ref_files, str):
             self.valid_ref_files = list([self.valid_ref_files])
 
         if from_translate:
+            # Masks are only needed for batched decoding
             self.valid_iterator = TextIterator(
-                                    mask=False,
-                                    batch_size=1,
+                                    mask=batch_size > 1,
+                                    batch_size=batch_size,
                                     file=self.data['valid_src'], dict=self.src_dict,
                                     n_words=self.n_words_src)
         else:
@@ -595,12 +590,19 @@ class Model(BaseModel):
 
         return cost
 
-    def build_sampler(self):
+    def build_sampler(self, batched=False, get_att_alphas=True):
         x           = tensor.matrix('x', dtype=INT)
         xr          = x[::-1]
         n_timesteps = x.shape[0]
         n_samples   = x.shape[1]
 
+        # Padded minibatches of sentences need the source mask
+        # for the encoder, the initial state and the attention.
+        x_mask = xr_mask = None
+        if batched:
+            x_mask  = tensor.matrix('x_mask', dtype=FLOAT)
+            xr_mask = x_mask[::-1]
+
         # word embedding (source), forward and backward
         emb = self.tparams['Wemb_enc'][x.flatten()]
         emb = emb.reshape([n_timesteps, n_samples, self.embedding_dim])
@@ -609,8 +611,8 @@ class Model(BaseModel):
         embr = embr.reshape([n_timesteps, n_samples, self.embedding_dim])
 
         # encoder
-        proj = get_new_layer(self.enc_type)[1](self.tparams, emb, prefix='encoder', layernorm=self.lnorm)
-        projr = get_new_layer(self.enc_type)[1](self.tparams, embr, prefix='encoder_r', layernorm=self.lnorm)
+        proj = get_new_layer(self.enc_type)[1](self.tparams, emb, prefix='encoder', mask=x_mask, layernorm=self.lnorm)
+        projr = get_new_layer(self.enc_type)[1](self.tparams, embr, prefix='encoder_r', mask=xr_mask, layernorm=self.lnorm)
 
         # concatenate forward and backward rnn hidden states
         ctx = [tensor.concatenate([proj[0], projr[0][::-1]], axis=proj[0].ndim-1)]
@@ -618,20 +620,26 @@ class Model(BaseModel):
         for i in range(1, self.n_enc_layers):
             ctx = get_new_layer(self.enc_type)[1](self.tparams, ctx[0],
                                                   prefix='deepencoder_%d' % i,
-                                                  layernorm=self.lnorm)
+                                                  mask=x_mask, layernorm=self.lnorm)
 
         ctx = ctx[0]
 
         if self.init_cgru == 'text' and 'ff_state_W' in self.tparams:
             # get the input for decoder rnn initializer mlp
-            ctx_mean = ctx.mean(0)
+            if batched:
+                ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+            else:
+                ctx_mean = ctx.mean(0)
             init_state = get_new_layer('ff')[1](self.tparams, ctx_mean, prefix='ff_state', activ='tanh')
         else:
             # assume zero-initialized decoder
             init_state = tensor.alloc(0., n_samples, self.rnn_dim)
 
-        outs = [init_state, ctx]
-        self.f_init = theano.function([x], outs, name='f_init')
+        if batched:
+            # The mask is given back to f_next along with the context
+            self.f_init = theano.function([x, x_mask], [init_state, ctx, x_mask], name='f_init')
+        else:
+            self.f_init = theano.function([x], [init_state, ctx], name='f_init')
 
         # x: 1 x 1
         y1 = tensor.vector('y1_sampler', dtype=INT)
@@ -655,6 +663,7 @@ class Model(BaseModel):
         r = get_new_layer('gru_cond')[1](self.tparams, emb_prev,
                                          prefix='decoder',
                                          mask=None, context=ctx,
+                                         context_mask=x_mask,
                                          one_step=True,
                                          init_state=init_state, layernorm=False)
 
@@ -669,7 +678,7 @@ class Model(BaseModel):
         logit = tanh(logit_gru + logit_prev + logit_ctx)
 
         if self.tied_trg_emb is False:
-            logit = get_new_layer('ff')[1](self.tparams, logit, prefix='ff_logit', activ='linear')
+            logit_trg = get_new_layer('ff')[1](self.tparams, logit, prefix='ff_logit_trg', activ='linear')
             logit_trgmult = get_new_layer('ff')[1](self.tparams, logit, prefix='ff_logit_trgmult', activ='linear')
         else:
             logit_trg = tensor.dot(logit, self.tparams['Wemb_dec_lem'].T)
@@ -679,19 +688,19 @@ class Model(BaseModel):
         next_log_probs_trg = tensor.nnet.logsoftmax(logit_trg)
         next_log_probs_trgmult = tensor.nnet.logsoftmax(logit_trgmult)
 
-        # Sample from the softmax distribution
-        next_probs_trg = tensor.exp(next_log_probs_trg)
-        next_probs_trgmult = tensor.exp(next_log_probs_trgmult)
-        next_word_trg = self.trng.multinomial(pvals=next_probs_trg).argmax(1)
-        next_word_trgmult = self.trng.multinomial(pvals=next_probs_trgmult).argmax(1)
-
         # NOTE: We never use sampling and it incurs performance penalty
         # let's disable it for now
         #next_word = self.trng.multinomial(pvals=next_probs).argmax(1)
 
         # compile a function to do the whole thing above
         # next hidden state to be used
-        inputs = [y1, y2, ctx, init_state]
-        outs = [next_log_probs_trg, next_word_trg, next_log_probs_trgmult, next_word_trgmult, next_state, alphas]
+        inputs = [y1, y2, init_state, ctx]
+        if batched:
+            inputs.append(x_mask)
+
+        outs = [next_log_probs_trg, next_log_probs_trgmult, next_state]
+        if get_att_alphas:
+            # Lean samplers skip returning the attention weights
+            outs.append(alphas)
 
         self.f_next = theano.function(inputs, outs, name='f_next')
@@ -10,15 +10,16 @@ class Model(Attention):
 
         self.data_mode = kwargs.get('data_mode', 'pairs')
 
-    def load_valid_data(self, from_translate=False, data_mode='single'):
+    def load_valid_data(self, from_translate=False, data_mode='single', batch_size=1):
         if from_translate:
             self.valid_ref_files = self.data['valid_trg']
             if isinstance(self.valid_ref_files, str):
                 self.valid_ref_files = list([self.valid_ref_files])
 
+            # Masks are only needed for batched decoding
             self.valid_iterator = WMTIterator(
-                    mask=False,
-                    batch_size=1,
+                    mask=batch_size > 1,
+                    batch_size=batch_size,
                     pklfile=self.data['valid_src'],
                     srcdict=self.src_dict, n_words_src=self.n_words_src,
                     mode=data_mode)
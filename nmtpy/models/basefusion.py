@@ -32,6 +32,7 @@ class Model(Attention):
         # on their specific decoder implementations
         self.init_gru_decoder   = None
         self.gru_decoder        = None
+        self.project_ctxs       = None
 
     def info(self):
         self.logger.info('Source vocabulary size: %d', self.n_words_src)
@@ -286,7 +287,7 @@ class Model(Attention):
 
         return cost
 
-    def build_sampler(self):
+    def build_sampler(self, get_att_alphas=True):
         x               = tensor.matrix('x', dtype=INT)
         n_timesteps     = x.shape[0]
         n_samples       = x.shape[1]
@@ -334,10 +335,18 @@ class Model(Attention):
         ################
         # Build f_init()
         ################
+        # Project both contexts for the attention once per sentence
+        # instead of recomputing them in every f_next call
+        pctx1, pctx2 = self.project_ctxs(self.tparams, text_ctx, img_ctx, prefix='decoder_multi')
+
         inps        = [x, x_img]
-        outs        = [init_state, text_ctx, img_ctx]
+        outs        = [init_state, text_ctx, img_ctx, pctx1, pctx2]
         self.f_init = theano.function(inps, outs, name='f_init')
 
+        # Like img_ctx (and thus pctx2), pctx1 is given untiled
+        # to f_next and broadcasted over the beam
+        pctx1       = tensor.addbroadcast(pctx1, 1)
+
         ###################
         # Target Embeddings
         ###################
@@ -355,7 +364,8 @@ class Model(Attention):
                                     ctx1=text_ctx, ctx1_mask=None,
                                     ctx2=img_ctx,
                                     one_step=True,
-                                    init_state=init_state)
+                                    init_state=init_state,
+                                    pctx1=pctx1, pctx2=pctx2)
         h      = dec_mult[0]
         sumctx = dec_mult[1]
         alphas = tensor.concatenate(dec_mult[2:], axis=-1)
@@ -380,8 +390,11 @@ class Model(Attention):
         ################
         # Build f_next()
         ################
-        inputs      = [y, init_state, text_ctx, img_ctx]
-        outs        = [next_log_probs, h, alphas]
+        inputs      = [y, init_state, text_ctx, img_ctx, pctx1, pctx2]
+        outs        = [next_log_probs, h]
+        if get_att_alphas:
+            # Lean samplers skip returning the attention weights
+            outs.append(alphas)
         self.f_next = theano.function(inputs, outs, name='f_next')
 
     def get_alpha_regularizer(self, alpha_c):
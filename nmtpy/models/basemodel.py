@@ -10,7 +10,7 @@ import theano.tensor as tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 import numpy as np
-from ..nmtutils import unzip, get_param_dict
+from ..nmtutils import unzip, get_param_dict, share_params
 from ..sysutils import readable_size, get_temp_file, get_valid_evaluation
 from ..defaults import INT, FLOAT
 
@@ -59,8 +59,10 @@ class BaseModel(object, metaclass=ABCMeta):
         self.options = OrderedDict([(k,v) for k,v in optdict.items() if v is not None])
 
     def set_trng(self, seed):
-        """Set the seed for Theano RNG."""
+        """Set the seed for Theano and NumPy RNGs."""
         self.trng = RandomStreams(seed)
+        # Used by gen_sample() for sampling
+        self.rng = np.random.RandomState(seed)
 
     def set_dropout(self, val):
         """Set dropout indicator for activation scaling if dropout is available through configuration."""
@@ -95,6 +97,13 @@ class BaseModel(object, metaclass=ABCMeta):
         for k,v in params.items():
             self.tparams[k] = theano.shared(v, name=k)
 
+    def share_params(self):
+        """Bind the shared variables to memory shared with forked
+        processes (see nmtutils.share_params)."""
+        params = OrderedDict([(k, v.get_value(borrow=True)) for k, v in self.tparams.items()])
+        for k, v in share_params(params).items():
+            self.tparams[k].set_value(v, borrow=True)
+
     def init_shared_variables(self):
         """Initialize the shared variables of the model."""
         # Create tensor dict
@@ -199,7 +208,7 @@ class BaseModel(object, metaclass=ABCMeta):
         else:
             self.train_batch = theano.function(list(self.inputs.values()), norm_cost, updates=updates)
 
-    def run_beam_search(self, beam_size=12, n_jobs=8, metric='bleu', mode='beamsearch', valid_mode='single', f_valid_out=None):
+    def run_beam_search(self, beam_size=12, n_jobs=8, metric='bleu', mode='beamsearch', valid_mode='single', f_valid_out=None, numpy=False):
         """Save model under /tmp for passing it to nmt-translate."""
         # Save model temporarily
         with get_temp_file(suffix=".npz", delete=True) as tmpf:
@@ -210,57 +219,85 @@ class BaseModel(object, metaclass=ABCMeta):
                                           mode=mode,
                                           metric=metric,
                                           valid_mode=valid_mode,
-                                          f_valid_out=f_valid_out)
+                                          f_valid_out=f_valid_out,
+                                          numpy=numpy)
 
         return result[metric]
 
     def gen_sample(self, input_dict, maxlen=50, argmax=False):
-        """Generate samples, do greedy (argmax) decoding or forced decoding."""
-        # A method that samples or takes the max proba's or
-        # does a forced decoding depending on the parameters.
-        final_sample = []
-        final_score = 0
-
-        target = None
-        if "y_true" in input_dict:
-            # We're doing forced decoding
-            target = input_dict.pop("y_true")
-            maxlen = len(target)
+        """Generate samples, do greedy (argmax) decoding or forced decoding.
+
+        input_dict holds either a single sentence or a padded minibatch of
+        sentences along with x_mask if the sampler is built with
+        batched=True. Reference target sentences in y_true (and y_true_mask
+        for minibatches) are scored for forced decoding. Returns a
+        (samples, scores, None) tuple for a single sentence and a list of
+        such tuples, one per sentence, for a minibatch."""
+        target = input_dict.pop("y_true", None)
+        input_dict.pop("y_true_mask", None)
+        batched = "x_mask" in input_dict
 
         inputs = list(input_dict.values())
 
-        next_state, ctx0 = self.f_init(*inputs)
+        # f_init gives the initial states and the contexts of every sentence
+        result = list(self.f_init(*inputs))
+        next_state, ctxs = result[0], result[1:]
+        n_sents = next_state.shape[0]
+
+        if target is not None:
+            # We're doing forced decoding
+            maxlen = target.shape[0]
+
+        # Words and scores of every sentence
+        samples = np.zeros((maxlen, n_sents), dtype=INT)
+        lengths = np.full(n_sents, maxlen, dtype=INT)
+        scores  = np.zeros(n_sents, dtype=FLOAT)
+
+        # Sentences that did not produce <eos> yet
+        live = np.arange(n_sents)
 
         # Beginning-of-sentence indicator is -1
-        next_word = np.array([-1], dtype=INT)
+        next_word = -1 * np.ones((n_sents, ), dtype=INT)
 
         for ii in range(maxlen):
             # Get next states
-            next_log_p, next_word, next_state = self.f_next(*[next_word, ctx0, next_state])
+            result = self.f_next(*([next_word, next_state] + ctxs))
+            next_log_p, next_state = result[0], result[1]
 
             if target is not None:
-                nw = int(target[ii])
+                next_word = target[ii, live].astype(INT)
 
             elif argmax:
                 # argmax() works the same for both probas and log_probas
-                nw = next_log_p[0].argmax()
+                next_word = next_log_p.argmax(1).astype(INT)
 
             else:
-                # Multinomial sampling
-                nw = next_word[0]
-
-            # 0: <eos>
-            if nw == 0:
-                break
+                # Multinomial sampling by inverting the cumulative distribution
+                cum_probs = np.exp(next_log_p).cumsum(1)
+                rand = self.rng.rand(live.size) * cum_probs[:, -1]
+                next_word = (cum_probs < rand[:, None]).sum(1).astype(INT)
 
-            # Add the word idx
-            final_sample.append(nw)
-            final_score -= next_log_p[0, nw]
+            # Add the word idxs and their scores, <eos> included
+            samples[ii, live] = next_word
+            scores[live] -= next_log_p[np.arange(live.size), next_word]
 
-        final_sample = [final_sample]
-        final_score = np.array(final_score)
-
-        return final_sample, final_score
+            # 0: <eos>
+            is_eos = next_word == 0
+            if is_eos.any():
+                lengths[live[is_eos]] = ii + 1
+
+                # Only keep the rows of unfinished sentences
+                keep        = np.nonzero(~is_eos)[0]
+                live        = live[keep]
+                if live.size == 0:
+                    break
+                next_word   = next_word[keep]
+                next_state  = next_state[keep]
+                if batched:
+                    ctxs = [c[:, keep] for c in ctxs]
+
+        results = [([samples[:lengths[i], i].tolist()], scores[i:i+1], None) for i in range(n_sents)]
+        return results if batched else results[0]
 
     def generate_samples(self, batch_dict, n_samples):
         # Silently fail if generate_samples is not reimplemented
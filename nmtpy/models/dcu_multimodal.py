@@ -41,7 +41,7 @@ def init_gru_decoder_multi(params, nin, dim, dimctx, scale=0.01, prefix='gru_dec
 def gru_decoder_multi(tparams, state_below,
                       ctx1, ctx2, prefix='gru_decoder_multi',
                       input_mask=None, one_step=False,
-                      init_state=None, ctx1_mask=None):
+                      init_state=None, ctx1_mask=None, pctx1=None):
     if one_step:
         assert init_state, 'previous state must be provided'
 
@@ -80,7 +80,9 @@ def gru_decoder_multi(tparams, state_below,
 
     # Wc_att: dimctx -> dimctx
     # Linearly transform the contexts to another space with same dimensionality
-    pctx1_ = tensor.dot(ctx1, tparams[pp(prefix, 'Wc_att')]) + tparams[pp(prefix, 'b_att')]
+    # Samplers precompute this once per sentence
+    if pctx1 is None:
+        pctx1 = tensor.dot(ctx1, tparams[pp(prefix, 'Wc_att')]) + tparams[pp(prefix, 'b_att')]
     # Do not transform image context again, it was already transformed by img_adaptor
 
     # Step function for the recurrence/scan
@@ -206,7 +208,7 @@ def gru_decoder_multi(tparams, state_below,
                   ]
 
     if one_step:
-        rval = _step(*(seqs + [init_state, None, None, None, None, pctx1_, ctx1, ctx2] + shared_vars))
+        rval = _step(*(seqs + [init_state, None, None, None, None, pctx1, ctx1, ctx2] + shared_vars))
     else:
         outputs_info=[init_state,
                       tensor.alloc(0., n_samples, ctx1.shape[2]), # ctxdim       (c_t)
@@ -217,7 +219,7 @@ def gru_decoder_multi(tparams, state_below,
         rval, updates = theano.scan(_step,
                                     sequences=seqs,
                                     outputs_info=outputs_info,
-                                    non_sequences=[pctx1_, ctx1, ctx2] + shared_vars,
+                                    non_sequences=[pctx1, ctx1, ctx2] + shared_vars,
                                     name=pp(prefix, '_layers'),
                                     n_steps=nsteps,
                                     strict=True)
@@ -491,7 +493,7 @@ class Model(Attention):
 
         return cost
 
-    def build_sampler(self):
+    def build_sampler(self, get_att_alphas=True):
         x               = tensor.matrix('x', dtype=INT)
         n_timesteps     = x.shape[0]
         n_samples       = x.shape[1]
@@ -539,10 +541,17 @@ class Model(Attention):
         ################
         # Build f_init()
         ################
+        # Project the text context for the attention once per sentence
+        # instead of recomputing it in every f_next call
+        pctx1 = tensor.dot(text_ctx, self.tparams['decoder_multi_Wc_att']) + self.tparams['decoder_multi_b_att']
+
         inps        = [x, x_img]
-        outs        = [init_state, text_ctx, img_ctx]
+        outs        = [init_state, text_ctx, img_ctx, pctx1]
         self.f_init = theano.function(inps, outs, name='f_init')
 
+        # Like img_ctx, pctx1 is given untiled to f_next and broadcasted over the beam
+        pctx1       = tensor.addbroadcast(pctx1, 1)
+
         ###################
         # Target Embeddings
         ###################
@@ -560,7 +569,8 @@ class Model(Attention):
                                     ctx1=text_ctx, ctx1_mask=None,
                                     ctx2=img_ctx,
                                     one_step=True,
-                                    init_state=init_state)
+                                    init_state=init_state,
+                                    pctx1=pctx1)
         h       = dec_mult[0]
         c_t     = dec_mult[1]
         i_t     = dec_mult[2]
@@ -586,8 +596,11 @@ class Model(Attention):
         ################
         # Build f_next()
         ################
-        inputs      = [y, init_state, text_ctx, img_ctx]
-        outs        = [next_log_probs, h, alphas]
+        inputs      = [y, init_state, text_ctx, img_ctx, pctx1]
+        outs        = [next_log_probs, h]
+        if get_att_alphas:
+            # Lean samplers skip returning the attention weights
+            outs.append(alphas)
         self.f_next = theano.function(inputs, outs, name='f_next')
 
     def get_alpha_regularizer(self, alpha_c):
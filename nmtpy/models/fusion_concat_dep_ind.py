@@ -19,6 +19,7 @@ class Model(Fusion):
         # Set architecture specific methods
         self.init_gru_decoder   = init_gru_decoder_multi
         self.gru_decoder        = gru_decoder_multi
+        self.project_ctxs       = project_ctxs
 
 ########################################################
 # DEP-IND Attention (att distinct, dec shared) Mechanism
@@ -41,10 +42,17 @@ def init_gru_decoder_multi(params, nin, dim, dimctx, scale=0.01, prefix='gru_dec
 
     return params
 
+def project_ctxs(tparams, ctx1, ctx2, prefix='gru_decoder_multi'):
+    # Wc_att: dimctx -> dimctx
+    # Linearly transform the contexts to another space with same dimensionality
+    pctx1_ = tensor.dot(ctx1, tparams[pp(prefix, 'Wc_att')]) + tparams[pp(prefix, 'b_att')]
+    pctx2_ = tensor.dot(ctx2, tparams[pp(prefix, 'Wc_att2')]) + tparams[pp(prefix, 'b_att2')]
+    return pctx1_, pctx2_
+
 def gru_decoder_multi(tparams, state_below,
                       ctx1, ctx2, prefix='gru_decoder_multi',
                       input_mask=None, one_step=False,
-                      init_state=None, ctx1_mask=None):
+                      init_state=None, ctx1_mask=None, pctx1=None, pctx2=None):
     if one_step:
         assert init_state, 'previous state must be provided'
 
@@ -81,10 +89,9 @@ def gru_decoder_multi(tparams, state_below,
     # This is the [W*x]_j in the eq. 8 of the paper
     state_belowx = tensor.dot(state_below, tparams[pp(prefix, 'Wx')]) + tparams[pp(prefix, 'bx')]
 
-    # Wc_att: dimctx -> dimctx
-    # Linearly transform the contexts to another space with same dimensionality
-    pctx1_ = tensor.dot(ctx1, tparams[pp(prefix, 'Wc_att')]) + tparams[pp(prefix, 'b_att')]
-    pctx2_ = tensor.dot(ctx2, tparams[pp(prefix, 'Wc_att2')]) + tparams[pp(prefix, 'b_att2')]
+    if pctx1 is None or pctx2 is None:
+        # Samplers precompute these once per sentence
+        pctx1, pctx2 = project_ctxs(tparams, ctx1, ctx2, prefix)
 
     # Step function for the recurrence/scan
     # Sequences
@@ -221,7 +228,7 @@ def gru_decoder_multi(tparams, state_below,
                    tparams[pp(prefix, 'c_fus')]]
 
     if one_step:
-        rval = _step(*(seqs + [init_state, None, None, None, pctx1_, pctx2_, ctx1, ctx2] + shared_vars))
+        rval = _step(*(seqs + [init_state, None, None, None, pctx1, pctx2, ctx1, ctx2] + shared_vars))
     else:
         outputs_info=[init_state,
                       tensor.alloc(0., n_samples, ctx1.shape[2]), # ctxdim       (ctx_)
@@ -231,7 +238,7 @@ def gru_decoder_multi(tparams, state_below,
         rval, updates = theano.scan(_step,
                                     sequences=seqs,
                                     outputs_info=outputs_info,
-                                    non_sequences=[pctx1_, pctx2_, ctx1, ctx2] + shared_vars,
+                                    non_sequences=[pctx1, pctx2, ctx1, ctx2] + shared_vars,
                                     name=pp(prefix, '_layers'),
                                     n_steps=nsteps,
                                     strict=True)
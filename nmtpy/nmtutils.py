@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import tempfile
+
 import numpy as np
 import pickle
 
@@ -53,9 +56,88 @@ def unzip(zipped):
 def pp(prefix, name):
     return '%s_%s' % (prefix, name)
 
-def get_param_dict(path):
-    """Fetch parameter dictionary from .npz file."""
-    return np.load(path)['tparams'].tolist()
+def get_param_dict(path, dequantize=True):
+    """Fetch parameter dictionary from .npz file.
+
+    int8 weights written by nmt-quantize are converted back to float
+    unless dequantize is False."""
+    params = np.load(path)['tparams'].tolist()
+    if dequantize:
+        params = dequantize_params(params)
+    return params
+
+# Suffix of the per-column scales of int8 weights
+QSCALE = '_qscale'
+
+def quantize_weight(W):
+    """Quantize a float matrix to int8 with a scale for each column."""
+    scale = np.abs(W).max(0) / 127.
+    scale[scale == 0] = 1.
+    Wq = np.clip(np.round(W / scale), -127, 127).astype(np.int8)
+    return Wq, scale.astype(FLOAT)
+
+def dequantize_params(params):
+    """Return a parameter dict where int8 weights are back to float."""
+    new_params = OrderedDict()
+    for kk, vv in params.items():
+        if kk.endswith(QSCALE):
+            continue
+        if vv.dtype == np.int8:
+            vv = vv.astype(FLOAT) * params[kk + QSCALE]
+        new_params[kk] = vv
+    return new_params
+
+# Suffixes of the low-rank factors of a weight (nmt-compress)
+SVD_A = '_svdA'
+SVD_B = '_svdB'
+
+def factorize_weight(W, rank=None, energy=0.95):
+    """Return truncated SVD factors A, B with W ~= A.B. If rank is not
+    given, it is the smallest one keeping this ratio of the energy (sum
+    of squared singular values)."""
+    u, s, vt = np.linalg.svd(W, full_matrices=False)
+    if rank is None:
+        cumulative = np.cumsum(s ** 2) / (s ** 2).sum()
+        rank = int(np.searchsorted(cumulative, energy) + 1)
+    rank = min(rank, s.size)
+    # Share the singular values between both factors
+    sq = np.sqrt(s[:rank])
+    return (u[:, :rank] * sq).astype(FLOAT), (sq[:, None] * vt[:rank]).astype(FLOAT)
+
+def factorize_params(params, ranks):
+    """Replace the weights given in the ranks dict by their factors."""
+    for name, rank in ranks.items():
+        W = params.pop(name)
+        params[name + SVD_A], params[name + SVD_B] = factorize_weight(W, rank)
+    return params
+
+def get_weight(params, name):
+    """Return a weight of a parameter dict, multiplying its factors if
+    it is factorized."""
+    if name + SVD_A in params:
+        return np.dot(params[name + SVD_A], params[name + SVD_B])
+    return params[name]
+
+def share_params(params):
+    """Return the parameters as views of a single shared memory mapping.
+
+    The mapping is backed by an already unlinked file under /dev/shm (or
+    the temporary directory) and is inherited by forked processes, which
+    thus read the same pages instead of getting their own copies."""
+    # Keep every array 64-byte aligned
+    sizes = [(v.nbytes + 63) // 64 * 64 for v in params.values()]
+    tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, prefix='nmtpy_params_') as f:
+        buf = np.memmap(f.name, dtype=np.uint8, mode='w+', shape=(max(sum(sizes), 1), ))
+
+    shared = OrderedDict()
+    offset = 0
+    for (kk, vv), size in zip(params.items(), sizes):
+        view = np.asarray(buf[offset:offset + vv.nbytes]).view(vv.dtype).reshape(vv.shape)
+        view[...] = vv
+        shared[kk] = view
+        offset += size
+    return shared
 
 # orthogonal initialization for weights
 # Saxe, Andrew M., James L. McClelland, and Surya Ganguli.
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .defaults import FLOAT
+from .beamsearch import beam_search, batch_beam_search, speculative_search
+from .mips import ClusteredSoftmax
+from .nmtutils import invert_dictionary, get_param_dict, share_params, QSCALE, SVD_A, SVD_B
+from .iterators.text import TextIterator
+
+#########################################
+# NumPy counterparts of nmtpy.layers
+# All of them work on (n_samples, dim) or
+# (n_timesteps, n_samples, dim) arrays.
+#########################################
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+#############################################
+# int8 weights with per-column scales written
+# by nmt-quantize stay int8 in memory and are
+# dequantized by blocks inside the GEMMs.
+# Weights factorized by nmt-compress are used
+# through their (possibly int8) factors.
+#############################################
+# Number of columns (rows for dot_t) dequantized at once
+QBLOCK = 4096
+
+def weight(params, name):
+    """Return a weight in float, dequantizing it if needed."""
+    if name + SVD_A in params:
+        return weight(params, name + SVD_A).dot(weight(params, name + SVD_B))
+    W = params[name]
+    if W.dtype == np.int8:
+        return W.astype(FLOAT) * params[name + QSCALE]
+    return W
+
+def take(params, name, idxs):
+    """Return the rows idxs of an embedding or lookup table."""
+    if name + SVD_A in params:
+        return dot(take(params, name + SVD_A, idxs), params, name + SVD_B)
+    W = params[name]
+    if W.dtype == np.int8:
+        return W[idxs].astype(FLOAT) * params[name + QSCALE]
+    return W[idxs]
+
+def dot(x, params, name, cols=None):
+    """Return x . params[name] (restricted to the columns cols if given)."""
+    if name + SVD_A in params:
+        return dot(dot(x, params, name + SVD_A), params, name + SVD_B, cols)
+    W = params[name]
+    if cols is not None:
+        W = W[:, cols]
+    if W.dtype != np.int8:
+        return x.dot(W)
+
+    # Scales apply to the columns of the product
+    scale = params[name + QSCALE]
+    if cols is not None:
+        scale = scale[cols]
+    out = np.empty(x.shape[:-1] + (W.shape[1], ), dtype=FLOAT)
+    for i in range(0, W.shape[1], QBLOCK):
+        out[..., i:i + QBLOCK] = x.dot(W[:, i:i + QBLOCK].astype(FLOAT)) * scale[i:i + QBLOCK]
+    return out
+
+def dot_t(x, params, name, rows=None):
+    """Return x . params[name].T (restricted to the rows if given)."""
+    if name + SVD_A in params:
+        return dot_t(dot_t(x, params, name + SVD_B), params, name + SVD_A, rows)
+    W = params[name]
+    if rows is not None:
+        W = W[rows]
+    if W.dtype != np.int8:
+        return x.dot(W.T)
+
+    # Scales apply to the columns of W, i.e. to x
+    x = x * params[name + QSCALE]
+    out = np.empty(x.shape[:-1] + (W.shape[0], ), dtype=FLOAT)
+    for i in range(0, W.shape[0], QBLOCK):
+        out[..., i:i + QBLOCK] = x.dot(W[i:i + QBLOCK].astype(FLOAT).T)
+    return out
+
+def log_softmax(x):
+    x = x - x.max(1, keepdims=True)
+    return x - np.log(np.exp(x).sum(1, keepdims=True))
+
+def layer_norm(x, b, s, eps=1e-5):
+    output = (x - x.mean(-1, keepdims=True)) / np.sqrt(x.var(-1, keepdims=True) + eps)
+    return s * output + b
+
+def gru_step(params, prefix, x_, xx_, h_, layernorm=False):
+    """One step of gru_step() or gru_step_lnorm() without the mask."""
+    dim = params[prefix + '_Ux'].shape[1]
+
+    if layernorm:
+        preact = sigmoid(layer_norm(dot(h_, params, prefix + '_U'), params[prefix + '_b3'], params[prefix + '_s3']) + x_)
+    else:
+        preact = sigmoid(dot(h_, params, prefix + '_U') + x_)
+
+    r = preact[:, :dim]
+    u = preact[:, dim:]
+
+    if layernorm:
+        h_tilda = np.tanh(layer_norm(dot(h_, params, prefix + '_Ux'), params[prefix + '_b4'], params[prefix + '_s4']) * r + xx_)
+    else:
+        h_tilda = np.tanh(dot(h_, params, prefix + '_Ux') * r + xx_)
+
+    return u * h_tilda + (1. - u) * h_
+
+def gru_layer(params, state_below, prefix='gru', mask=None, layernorm=False):
+    """Run a GRU over state_below (n_timesteps x n_samples x nin).
+
+    The input projections of all timesteps are computed at once."""
+    n_steps, n_samples = state_below.shape[:2]
+    dim = params[prefix + '_Ux'].shape[1]
+
+    state_below_ = dot(state_below, params, prefix + '_W') + params[prefix + '_b']
+    state_belowx = dot(state_below, params, prefix + '_Wx') + params[prefix + '_bx']
+    if layernorm:
+        state_below_ = layer_norm(state_below_, params[prefix + '_b1'], params[prefix + '_s1'])
+        state_belowx = layer_norm(state_belowx, params[prefix + '_b2'], params[prefix + '_s2'])
+
+    h = np.zeros((n_samples, dim), dtype=FLOAT)
+    hs = np.empty((n_steps, n_samples, dim), dtype=FLOAT)
+    for t in range(n_steps):
+        h_new = gru_step(params, prefix, state_below_[t], state_belowx[t], h, layernorm)
+        if mask is not None:
+            # Padded positions keep the previous state
+            m_ = mask[t][:, None]
+            h_new = m_ * h_new + (1. - m_) * h
+        hs[t] = h = h_new
+    return hs
+
+def gru_cond_step(params, prefix, x_, xx_, h_, context, pctx, context_mask=None):
+    """One step of gru_cond_layer(). Returns the next state, the weighted
+    context and the attention weights (n_samples x n_timesteps)."""
+    p = lambda name: params[prefix + '_' + name]
+    pdot = lambda x, name: dot(x, params, prefix + '_' + name)
+    dim = p('Wcx').shape[1]
+
+    # First GRU
+    h1 = gru_step(params, prefix, x_, xx_, h_)
+
+    # Attention
+    pctx__ = np.tanh(pctx + pdot(h1, 'W_comb_att')[None, :, :])
+    alpha = pdot(pctx__, 'U_att')[:, :, 0] + p('c_att')
+    alpha = np.exp(alpha - alpha.max(0, keepdims=True))
+    if context_mask is not None:
+        alpha = alpha * context_mask
+    alpha = alpha / alpha.sum(0, keepdims=True)
+    ctx_ = np.einsum('ts,tsd->sd', alpha, context)
+
+    # Second GRU
+    preact2 = sigmoid(pdot(h1, 'U_nl') + p('b_nl') + pdot(ctx_, 'Wc'))
+    r2 = preact2[:, :dim]
+    u2 = preact2[:, dim:]
+
+    h2_tilda = np.tanh((pdot(h1, 'Ux_nl') + p('bx_nl')) * r2 + pdot(ctx_, 'Wcx'))
+    h2 = u2 * h2_tilda + (1. - u2) * h1
+
+    return h2, ctx_, alpha.T
+
+class NumpyModel(object):
+    """Theano-free sampler for attention models.
+
+    The encoder, one step of the conditional GRU decoder and the readout
+    of nmtpy.models.attention are computed with NumPy from the parameters
+    of a checkpoint. It provides the subset of the model interface used by
+    nmt-translate for beam search: load(), build_sampler() creating the
+    f_init/f_next callables, beam_search(), batch_beam_search() and
+    load_valid_data(). Startup is only the time to load the .npz file.
+    Weights quantized by nmt-quantize are kept as int8 in memory."""
+
+    # Model types with the sampler computed here
+    MODEL_TYPES = ('attention', )
+
+    # Beam searches only use the samplers (see nmtpy.beamsearch)
+    beam_search         = staticmethod(beam_search)
+    batch_beam_search   = staticmethod(batch_beam_search)
+    speculative_search  = staticmethod(speculative_search)
+
+    def __init__(self, seed, logger, **kwargs):
+        # Merge incoming parameters
+        self.__dict__.update(kwargs)
+
+        if self.model_type not in self.MODEL_TYPES:
+            raise NotImplementedError("NumpyModel does not support '%s' models" % self.model_type)
+
+        self.enc_type       = kwargs.get('enc_type', 'gru')
+        if self.enc_type != 'gru':
+            raise NotImplementedError("NumpyModel only supports GRU encoders")
+
+        self.lnorm          = kwargs.get('layer_norm', False)
+        self.init_cgru      = kwargs.get('init_cgru', 'text')
+        self.n_enc_layers   = kwargs.get('n_enc_layers', 1)
+        self.tied_trg_emb   = kwargs.get('tied_trg_emb', False)
+
+        # nmt-translate gives the dictionaries through the options
+        self.src_idict      = invert_dictionary(self.src_dict)
+        self.trg_idict      = invert_dictionary(self.trg_dict)
+
+        self.logger         = logger
+
+        self.params         = None
+        self.f_init         = None
+        self.f_next         = None
+
+    def load(self, fname):
+        """Restore the parameters of a .npz checkpoint file."""
+        self.params = dict([(k, np.ascontiguousarray(v, dtype=v.dtype if v.dtype == np.int8 else FLOAT))
+                            for k, v in get_param_dict(fname, dequantize=False).items()])
+
+    def share_params(self):
+        """Move the parameters to memory shared with forked processes
+        (see nmtutils.share_params)."""
+        self.params = share_params(self.params)
+
+    def set_dropout(self, val):
+        """Dropout is never used for decoding."""
+        pass
+
+    def load_valid_data(self, from_translate=True, batch_size=1):
+        self.valid_ref_files = self.data['valid_trg']
+        if isinstance(self.valid_ref_files, str):
+            self.valid_ref_files = list([self.valid_ref_files])
+
+        # Masks are only needed for batched decoding
+        self.valid_iterator = TextIterator(
+                                mask=batch_size > 1,
+                                batch_size=batch_size,
+                                file=self.data['valid_src'], dict=self.src_dict,
+                                n_words=self.n_words_src)
+        self.valid_iterator.read()
+
+    def encode(self, x, x_mask=None):
+        """Return the initial decoder state, the source annotations
+        and their projection for the attention."""
+        p = self.params
+
+        # word embedding (source), forward and backward
+        emb = take(p, 'Wemb_enc', x)
+        xr_mask = None if x_mask is None else x_mask[::-1]
+
+        proj  = gru_layer(p, emb, prefix='encoder', mask=x_mask, layernorm=self.lnorm)
+        projr = gru_layer(p, emb[::-1], prefix='encoder_r', mask=xr_mask, layernorm=self.lnorm)
+
+        # concatenate forward and backward rnn hidden states
+        ctx = np.concatenate([proj, projr[::-1]], axis=2)
+
+        for i in range(1, self.n_enc_layers):
+            ctx = gru_layer(p, ctx, prefix='deep_encoder_%d' % i, mask=x_mask, layernorm=self.lnorm)
+
+        if self.init_cgru == 'text' and 'ff_state_b' in p:
+            if x_mask is not None:
+                ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+            else:
+                ctx_mean = ctx.mean(0)
+            init_state = np.tanh(dot(ctx_mean, p, 'ff_state_W') + p['ff_state_b'])
+        else:
+            # assume zero-initialized decoder
+            init_state = np.zeros((x.shape[1], self.rnn_dim), dtype=FLOAT)
+
+        pctx = dot(ctx, p, 'decoder_Wc_att') + p['decoder_b_att']
+
+        return init_state.astype(FLOAT), ctx, pctx
+
+    def lookup(self, y, weight, bias, table):
+        """Return emb(y) x W + b, with emb(-1) being zero. Uses the
+        vocabulary-indexed table if the model has it (nmt-precompute)."""
+        p = self.params
+        first = (y < 0)[:, None]
+        if table in p:
+            out = take(p, table, np.maximum(y, 0))
+        else:
+            out = dot(take(p, 'Wemb_dec', np.maximum(y, 0)), p, weight) + p[bias]
+        return np.where(first, p[bias], out)
+
+    def decode_step(self, y, init_state, ctx, pctx, x_mask=None, vocab=None):
+        """Return the log-probabilities of the next words (only for the
+        target words in vocab if given), the next decoder state, the
+        attention weights and the readout before the output layer."""
+        p = self.params
+
+        next_state, ctxs, alphas = gru_cond_step(
+            p, 'decoder',
+            self.lookup(y, 'decoder_W', 'decoder_b', 'decoder_W_table'),
+            self.lookup(y, 'decoder_Wx', 'decoder_bx', 'decoder_Wx_table'),
+            init_state, ctx, pctx, x_mask)
+
+        logit_prev = self.lookup(y, 'ff_logit_prev_W', 'ff_logit_prev_b', 'ff_logit_prev_table')
+        logit_ctx  = dot(ctxs, p, 'ff_logit_ctx_W') + p['ff_logit_ctx_b']
+        logit_gru  = dot(next_state, p, 'ff_logit_gru_W') + p['ff_logit_gru_b']
+
+        readout = np.tanh(logit_gru + logit_prev + logit_ctx)
+
+        return self.output_layer(readout, vocab), next_state, alphas, readout
+
+    def output_layer(self, readout, vocab=None):
+        """Return the log-probabilities of the target words (only for the
+        words in vocab if given) from the readout."""
+        p = self.params
+        if self.tied_trg_emb is False:
+            logit = dot(readout, p, 'ff_logit_W', vocab)
+            logit += p['ff_logit_b'] if vocab is None else p['ff_logit_b'][vocab]
+        else:
+            logit = dot_t(readout, p, 'Wemb_dec', vocab)
+
+        return log_softmax(logit)
+
+    def verify(self, y, init_state, ctx, pctx):
+        """Feed the words y (n_steps x n_samples) to the decoder starting
+        from init_state. Returns the log-probabilities and the decoder
+        states after each step, the output layer being computed for all
+        steps at once."""
+        p = self.params
+        n_steps, n_samples = y.shape
+        y = y.ravel()
+
+        below_  = self.lookup(y, 'decoder_W', 'decoder_b', 'decoder_W_table').reshape(n_steps, n_samples, -1)
+        belowx  = self.lookup(y, 'decoder_Wx', 'decoder_bx', 'decoder_Wx_table').reshape(n_steps, n_samples, -1)
+
+        states = np.empty((n_steps, ) + init_state.shape, dtype=FLOAT)
+        ctxs = np.empty((n_steps, n_samples, ctx.shape[-1]), dtype=FLOAT)
+        state = init_state
+        for t in range(n_steps):
+            state, ctxs[t], _ = gru_cond_step(p, 'decoder', below_[t], belowx[t], state, ctx, pctx)
+            states[t] = state
+
+        # Readout of all steps at once
+        logit_prev = self.lookup(y, 'ff_logit_prev_W', 'ff_logit_prev_b', 'ff_logit_prev_table')
+        logit_ctx  = dot(ctxs.reshape(n_steps * n_samples, -1), p, 'ff_logit_ctx_W') + p['ff_logit_ctx_b']
+        logit_gru  = dot(states.reshape(n_steps * n_samples, -1), p, 'ff_logit_gru_W') + p['ff_logit_gru_b']
+        readout = np.tanh(logit_gru + logit_prev + logit_ctx)
+
+        log_probs = self.output_layer(readout)
+        return log_probs.reshape(n_steps, n_samples, -1), states
+
+    def build_sampler(self, batched=False, get_att_alphas=True, shortlist=False,
+                      approx_clusters=0, approx_nbest=16):
+        """Create f_init/f_next with the same inputs and outputs as the
+        Theano functions of nmtpy.models.attention."""
+        if batched:
+            # The mask is given back to f_next along with the contexts
+            def f_init(x, x_mask):
+                return list(self.encode(x, x_mask)) + [x_mask]
+        else:
+            def f_init(x):
+                return list(self.encode(x))
+
+        def f_next(y, init_state, ctx, pctx, *args):
+            x_mask = args[0] if batched else None
+            vocab = args[-1] if shortlist else None
+            log_probs, next_state, alphas, readout = \
+                self.decode_step(y, init_state, ctx, pctx, x_mask, vocab)
+
+            outs = [log_probs, next_state]
+            if approx_clusters > 0:
+                # The output layer is approximated by ClusteredSoftmax
+                outs[0] = readout
+            if get_att_alphas:
+                outs.append(alphas)
+            return outs
+
+        self.f_init = f_init
+        self.f_next = f_next
+
+        if approx_clusters > 0:
+            # NOTE: The clusters need float output embeddings
+            if self.tied_trg_emb is False:
+                W, b = weight(self.params, 'ff_logit_W'), self.params['ff_logit_b']
+            else:
+                W = weight(self.params, 'Wemb_dec').T
+                b = np.zeros((W.shape[1], ), dtype=FLOAT)
+            self.f_next = ClusteredSoftmax(W, b, approx_clusters, approx_nbest).wrap(self.f_next)
+
+    def build_verifier(self):
+        """Create f_verify for speculative_search() with the same inputs
+        and outputs as the Theano function of nmtpy.models.attention."""
+        def f_verify(y, init_state, ctx, pctx):
+            return list(self.verify(y, init_state, ctx, pctx))
+
+        self.f_verify = f_verify
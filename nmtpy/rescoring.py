@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .defaults import INT, FLOAT
+
+def read_nbest(fname):
+    """Read an n-best list in 'idx ||| hyp ||| score' format.
+
+    Returns a list of (idx, hyp, score) tuples in file order."""
+    nbest = []
+    with open(fname) as f:
+        for line in f:
+            idx, hyp, score = line.rstrip('\n').split(' ||| ')[:3]
+            nbest.append((int(idx), hyp.strip(), score.strip()))
+    return nbest
+
+def pad_hyps(hyps):
+    """Pad hypotheses (lists of idxs ending with <eos>) into a matrix."""
+    lengths = np.array([len(h) for h in hyps], dtype=INT)
+    tokens = np.zeros((len(hyps), lengths.max()), dtype=INT)
+    for i, h in enumerate(hyps):
+        tokens[i, :len(h)] = h
+    return tokens, lengths
+
+def score_prefix_trie(f_next, init_state, ctxs, hyps, hyp_sents, gather):
+    """Return the negative log-likelihoods of hypotheses under a sampler.
+
+    init_state and ctxs are the f_init outputs of the source sentences and
+    hyps are lists of target idxs ending with <eos>, hyp_sents giving the
+    source sentence of each one. Hypotheses sharing a prefix share its
+    decoder states: at each step f_next is called once for the unique
+    prefixes of all sentences, i.e. the nodes of their prefix trie at that
+    depth. gather(ctxs, node_sents) should return the f_next contexts for
+    the given source sentence of each node. Returns the scores and the
+    number of rows given to f_next."""
+    tokens, lengths = pad_hyps(hyps)
+    n_hyps, maxlen = tokens.shape
+    scores = np.zeros(n_hyps, dtype=FLOAT)
+
+    # The root of each sentence's trie has the initial state
+    node_sents  = np.arange(init_state.shape[0])
+    next_w      = -1 * np.ones(node_sents.shape, dtype=INT)
+    next_state  = init_state
+
+    # Trie node of each hypothesis at the current depth
+    hyp_nodes   = np.array(hyp_sents, dtype=INT)
+    n_rows      = 0
+
+    for t in range(maxlen):
+        result = f_next(*([next_w, next_state] + gather(ctxs, node_sents)))
+        log_p, next_state = result[0], result[1]
+        n_rows += next_w.size
+
+        # Accumulate the scores of the hypotheses having a t'th word
+        active = np.nonzero(lengths > t)[0]
+        words = tokens[active, t]
+        scores[active] -= log_p[hyp_nodes[active], words]
+
+        # Child nodes are the unique (parent, word) pairs of continuing hypotheses
+        cont = lengths[active] > t + 1
+        if not cont.any():
+            break
+        active, words = active[cont], words[cont]
+        keys = hyp_nodes[active] * log_p.shape[1] + words
+        keys, hyp_nodes[active] = np.unique(keys, return_inverse=True)
+
+        parents     = keys // log_p.shape[1]
+        next_w      = (keys % log_p.shape[1]).astype(INT)
+        next_state  = next_state[parents]
+        node_sents  = node_sents[parents]
+
+    return scores, n_rows
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .defaults import INT
+
+class Shortlist(object):
+    """Source-conditioned target vocabulary built by nmt-shortlist.
+
+    The vocabulary of a source sentence is the union of the candidate
+    target words of its source words and the most frequent target words.
+    It is sorted so that <eos> (0) and <unk> (1) keep their indices."""
+    def __init__(self, fname, n_cands=None, n_freq=None):
+        data = np.load(fname)
+
+        # n_words_src x max_cands, padded with -1
+        self.cands  = data['cands'][:, :n_cands]
+
+        # Target words always in the vocabulary
+        self.base   = np.union1d([0, 1], data['freqs'][:n_freq])
+
+        self.n_cands = self.cands.shape[1]
+        self.n_freq  = self.base.size - 2
+
+    def get_vocab(self, x):
+        """Return the sorted target vocabulary for the source idxs x."""
+        cands = self.cands[np.unique(x)]
+        return np.union1d(self.base, cands[cands >= 0]).astype(INT)
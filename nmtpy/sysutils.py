@@ -116,6 +116,22 @@ def readable_size(n):
             break
     return '%.1f%s' % (size, fmt)
 
+def get_memory_usage(pid):
+    """Return the unique (private) and shared resident memory of a process
+    in bytes from /proc/<pid>/smaps or None if it is not available."""
+    usage = {'Private': 0, 'Shared': 0}
+    fname = '/proc/%d/smaps_rollup' % pid
+    if not os.path.exists(fname):
+        fname = '/proc/%d/smaps' % pid
+    try:
+        with open(fname) as f:
+            for line in f:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:', 'Shared_Clean:', 'Shared_Dirty:')):
+                    usage[line.split('_')[0]] += int(line.split()[1]) * 1024
+    except OSError as oe:
+        return None
+    return usage['Private'], usage['Shared']
+
 def get_temp_file(suffix="", name=None, delete=False):
     """Creates a temporary file under /tmp."""
     if name:
@@ -132,10 +148,14 @@ def get_temp_file(suffix="", name=None, delete=False):
     return t
 
 def get_valid_evaluation(save_path, beam_size, n_jobs, mode, metric,
-                         valid_mode='single', trans_cmd='nmt-translate', f_valid_out=None, factors=None):
+                         valid_mode='single', trans_cmd='nmt-translate', f_valid_out=None, factors=None,
+                         numpy=False):
     """Run nmt-translate for validation during training."""
     cmd = [trans_cmd, "-b", str(beam_size), "-D", mode,
            "-j", str(n_jobs), "-m", save_path, "-M", metric, "-v", valid_mode]
+    # Theano-free samplers avoid the compilation in each validation
+    if numpy:
+        cmd.append("--numpy")
     # Factors option needs -fa option with the script and 2 output files
     if factors:
         cmd.extend(["-fa", factors, "-o", f_valid_out[0], f_valid_out[1]])
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Text processing related functions"""
+from .sysutils import fopen
 
 def reduce_to_best(hyps, scores, n_unique_samples, avoid_unk=True):
     """Pick the best of each hypotheses group based on their scores."""
@@ -14,3 +15,18 @@ def reduce_to_best(hyps, scores, n_unique_samples, avoid_unk=True):
     # Now each element of "groups" contain let's say 5 hypotheses and their scores
     # Sort them and get the first (smallest score)
     return [sorted(g, key=lambda x: x[1])[0][0] for g in groups]
+
+def get_length_ratio(src_file, trg_file, n_std=3.):
+    """Return mean + n_std * std of the target/source length ratios of a bitext."""
+    ratios = []
+    with fopen(src_file) as fs, fopen(trg_file) as ft:
+        for src, trg in zip(fs, ft):
+            # Skip the pairs ignored by BiTextIterator
+            if src.strip() == "" or trg.strip() == "":
+                continue
+            # +1 for <eos>
+            ratios.append((len(trg.split()) + 1.) / (len(src.split()) + 1.))
+
+    mean = sum(ratios) / len(ratios)
+    std = (sum([(r - mean) ** 2 for r in ratios]) / len(ratios)) ** 0.5
+    return mean + n_std * std
@@ -41,6 +41,14 @@ setup(
         scripts=[
                     'bin/nmt-train',
                     'bin/nmt-extract',
+                    'bin/nmt-precompute',
+                    'bin/nmt-quantize',
+                    'bin/nmt-compress',
+                    'bin/nmt-trim-vocab',
+                    'bin/nmt-average',
+                    'bin/nmt-distill',
+                    'bin/nmt-shortlist',
+                    'bin/nmt-rescore',
                     'bin/nmt-translate',
                     'bin/nmt-translate-factors', # Factored NMT variant.
                     'bin/nmt-build-dict',